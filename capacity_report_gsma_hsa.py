@@ -4,119 +4,346 @@
 # Author: Claudiu Tomescu
 # e-mail: klau2005@tutanota.com
 
-import re, sys, requests
-from subprocess import getstatusoutput as get_stat
-
-# convert full CPU resource value from k8s into milicpu format (eg. from 1 to 1000)
-def conv_cpu_val(val):
-    if not "m" in val:
-        result = int(val) * 1000
-    else:
-        result = int(val.strip("m"))
-    return result
-
-# convert memory resource value from k8s from KB/GB into MB (eg. from 4046588Ki to 3951 or from 2Gi to 2048)
-def conv_mem_val(val):
-    if "K" in val:
-        result = int(val.strip("Ki")) // 1024
-    elif "G" in val:
-        result = int(val.strip("Gi")) * 1024
-    else:
-        result = int(val.strip("Mi"))
-    return result
-
-# create function to extract metrics from k8s raw data
-def get_k8s_value(data, metric):
-    i = 0
-    while i < len(data)-3: # we don't go further as this is the last line we care about
-        # search for the line that contains "Capacity:" to get CPU and memory allocated
-        if re.match("^ *Capacity:", data[i]):
-            # if we need CPUs number, search for the second line after the match
-            if metric == "cpus_number":
-                metric_line = i+2
-                value = data[metric_line].split("\t")[-1]
-            # if we need memory size, search for the third line after the match
-            elif metric == "memory_capacity":
-                metric_line = i+3
-                value = conv_mem_val(data[metric_line].split("\t")[-1])
-        # search for the line that starts with "CPU Requests" to get resource usage
-        elif re.match("^ *CPU Requests", data[i]):
-            metric_line = i+2
-            if metric == "cpu_requests":
-                value = conv_cpu_val(data[metric_line].split()[0])
-            elif metric == "cpu_requests_perc":
-                value = data[metric_line].split()[1].strip("()").strip("%")
-            elif metric == "cpu_limits":
-                value = conv_cpu_val(data[metric_line].split()[2])
-            elif metric == "cpu_limits_perc":
-                value = data[metric_line].split()[3].strip("()").strip("%")
-            elif metric == "mem_requests":
-                value = conv_mem_val(data[metric_line].split()[4])
-            elif metric == "mem_requests_perc":
-                value = data[metric_line].split()[5].strip("()").strip("%")
-            elif metric == "mem_limits":
-                value = conv_mem_val(data[metric_line].split()[6])
-            elif metric == "mem_limits_perc":
-                value = data[metric_line].split()[7].strip("()").strip("%")
-        i+=1
-    return value
-
-# create dictionary for storing final data to generate report from
-report_dict = {}
-# define empty dictionary to store nodes and raw metrics from kubectl describe command
-nodes_dict = {}
-
-# run kubectl command and get list of nodes
-nodes_status = get_stat("kubectl get no | awk '!/NAME/{print $1}'")[0]
-if nodes_status == 0:
-    k8s_nodes_list = get_stat("kubectl get no | awk '!/NAME/{print $1}'")[1].split("\n")
-    # populate nodes_dict
-    for srv in k8s_nodes_list:
-        nodes_dict[srv] = {}
-else:
-    print("kubectl command failed")
-    sys.exit(2)
-
-# get metrics for each node
-for srv in nodes_dict.keys():
-    comm = "kubectl describe no {}".format(srv)
-    result = get_stat(comm)
-    metrics_status = result[0]
-    if metrics_status == 0:
-        nodes_dict[srv] = result[1].split("\n")
-    else:
-        print("kubectl command failed")
+import argparse, csv, hashlib, json, os, queue, subprocess, sys, threading, time, requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from k8s_resources import add_totals, empty_totals, node_record, parse_node, parse_quantity, pod_counted, pod_requests_limits
+
+# how many kubectl describe commands we run at once and how many seconds each of them may take
+workers = 8
+kubectl_timeout = 60
+# parsed node rows of the previous runs, reused for the nodes whose pods and capacity didn't change
+cache_file = os.path.expanduser("~/.cache/k8s_capacity_report.json")
+# watch mode: seconds we wait before listing again when a watch ended (so a failing kubectl doesn't spin)
+watch_retry = 5
+
+# run a kubectl command directly (no shell), returns (return code, output)
+# a command that doesn't finish in time counts as failed
+def run_kubectl(args, timeout):
+    try:
+        result = subprocess.run(["kubectl"] + args, stdout = subprocess.PIPE, stderr = subprocess.STDOUT,
+            universal_newlines = True, timeout = timeout)
+    except subprocess.TimeoutExpired:
+        return -1, "timed out after {}s".format(timeout)
+    except OSError as e:
+        return -1, str(e)
+    return result.returncode, result.stdout
+
+# run a kubectl get printing custom columns, returns the rows as lists of fields
+def get_columns(args, columns, timeout):
+    status, output = run_kubectl(["get"] + args + ["--no-headers", "-o", "custom-columns=" + ",".join(columns)], timeout)
+    if status != 0:
+        print("kubectl command failed: {}".format(output.strip()), file = sys.stderr)
         sys.exit(2)
+    return [line.split() for line in output.split("\n") if line.strip()]
+
+# get the list of nodes and a key of what each node's describe depends on: its capacity/allocatable
+# and the uid/resourceVersion of its non-terminated pods (2 kubectl calls whatever the cluster size)
+# returns {"node": key}, in the order kubectl lists the nodes
+def get_node_keys(timeout):
+    nodes = get_columns(["nodes"], ["NAME:.metadata.name", "CPU:.status.capacity.cpu", "MEM:.status.capacity.memory",
+        "ACPU:.status.allocatable.cpu", "AMEM:.status.allocatable.memory"], timeout)
+    pods = get_columns(["pods", "--all-namespaces"], ["NODE:.spec.nodeName", "UID:.metadata.uid",
+        "RV:.metadata.resourceVersion", "PHASE:.status.phase"], timeout)
+    node_pods = {}
+    for node_name, uid, resource_version, phase in pods:
+        # describe only counts non-terminated pods
+        if phase not in ("Succeeded", "Failed"):
+            node_pods.setdefault(node_name, []).append(uid + ":" + resource_version)
+    keys = {}
+    for node in nodes:
+        digest = hashlib.sha256(" ".join(node[1:]).encode())
+        for pod in sorted(node_pods.get(node[0], [])):
+            digest.update(b" " + pod.encode())
+        keys[node[0]] = digest.hexdigest()
+    return keys
+
+# cached rows: {"node": {"key": key, "metrics": metrics}}, empty if there is no (readable) cache
+def load_cache(file_name):
+    try:
+        with open(file_name) as cache:
+            return json.load(cache)
+    except (OSError, ValueError):
+        return {}
+
+# save the cache (only the nodes the cluster still has), through a temporary file so a crash
+# never leaves a truncated cache behind
+def save_cache(file_name, cache):
+    try:
+        os.makedirs(os.path.dirname(file_name), exist_ok = True)
+        with open(file_name + ".tmp", "w") as cache_file:
+            json.dump(cache, cache_file)
+        os.replace(file_name + ".tmp", file_name)
+    except OSError as e:
+        print("Can't save the node cache: {}".format(e), file = sys.stderr)
+
+# columns of the report: CSV header and the metrics key of each column (JSON lines use the keys)
+report_columns = [("Server", "Server"), ("CPUs number", "CPUs number"), ("Memory capacity(MB)", "Memory capacity"),
+    ("CPU requests", "CPU requests"), ("CPU requests percent", "CPU requests percent"), ("CPU limits", "CPU limits"),
+    ("CPU limits percent", "CPU limits percent"), ("Memory requests(MB)", "Memory requests"),
+    ("Memory requests percent", "Memory requests percent"), ("Memory limits(MB)", "Memory limits"),
+    ("Memory limits percent", "Memory limits percent")]
+output_formats = ("csv", "jsonl")
+# metrics kept as strings the way kubectl prints them, JSON lines turn them into numbers
+percent_metrics = ("CPU requests percent", "CPU limits percent", "Memory requests percent", "Memory limits percent")
+
+# all the metrics of a node from its kubectl describe output, None if it can't be parsed
+def node_metrics(data):
+    node = parse_node(data)
+    if node is None:
+        return None
+    return record_metrics(node)
+
+# report metrics of a NodeRecord
+def record_metrics(node):
+    metrics = {}
+    metrics["CPUs number"] = node.cpus_number
+    metrics["Memory capacity"] = node.memory_capacity
+    metrics["CPU requests"] = node.cpu_requests
+    metrics["CPU requests percent"] = node.cpu_requests_perc
+    metrics["CPU limits"] = node.cpu_limits
+    metrics["CPU limits percent"] = node.cpu_limits_perc
+    metrics["Memory requests"] = node.mem_requests
+    metrics["Memory requests percent"] = node.mem_requests_perc
+    metrics["Memory limits"] = node.mem_limits
+    metrics["Memory limits percent"] = node.mem_limits_perc
+    return metrics
+
+# describe the nodes through a bounded pool of kubectl processes, parsing each output as soon as
+# its command completes; yields (node, metrics) in completion order, metrics is None for the nodes
+# whose describe failed, timed out or can't be parsed
+def describe_nodes(nodes, workers, timeout):
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        futures = {executor.submit(run_kubectl, ["describe", "no", srv], timeout): srv for srv in nodes}
+        for future in as_completed(futures):
+            # drop the future (and its output) once parsed, memory doesn't grow with the cluster
+            srv = futures.pop(future)
+            status, output = future.result()
+            if status != 0:
+                print("kubectl command failed for {}: {}".format(srv, output.strip()), file = sys.stderr)
+                yield srv, None
+                continue
+            try:
+                metrics = node_metrics(output.split("\n"))
+            except ValueError:
+                metrics = None
+            if metrics is None:
+                print("cannot parse kubectl describe output of {}".format(srv), file = sys.stderr)
+            yield srv, metrics
+
+# writes the report rows to stdout as soon as they are ready, as CSV (header first) or JSON lines
+# (one object per node), flushing each row so a downstream tool gets it right away
+class RowWriter:
+    def __init__(self, output_format, out = sys.stdout):
+        self.output_format = output_format
+        self.out = out
+        if output_format == "csv":
+            self.csv = csv.writer(out, lineterminator = "\n")
+            self.csv.writerow([header for header, _ in report_columns])
+            out.flush()
+
+    def write(self, srv, metrics):
+        row = dict(metrics, Server = srv)
+        if self.output_format == "csv":
+            self.csv.writerow([row[key] for _, key in report_columns])
+        else:
+            values = {key: row[key] for _, key in report_columns}
+            # CPU capacity is a quantity (usually whole cores, "1500m" is 1.5)
+            cpus = parse_quantity(values["CPUs number"])
+            values["CPUs number"] = int(cpus) if cpus == int(cpus) else float(cpus)
+            for key in percent_metrics:
+                values[key] = int(values[key])
+            self.out.write(json.dumps(values) + "\n")
+        self.out.flush()
+
+### Watch mode ###
+# allocations of the cluster kept up to date from node and pod events: each pod's requests/limits
+# are summed into its node, so an event only changes the totals (and the row) of the node(s) it touches
+class ClusterState:
+    def __init__(self):
+        self.nodes = {}
+        # {"pod uid": (node name, resourceVersion, requests/limits totals)}
+        self.pods = {}
+        self.sums = {}
 
-# populate report dictionary with needed metrics
-for srv in nodes_dict.keys():
-    report_dict[srv] = {}
-
-for srv in report_dict.keys():
-    report_dict[srv]["CPUs number"] = get_k8s_value(nodes_dict[srv], "cpus_number")
-    report_dict[srv]["Memory capacity"] = get_k8s_value(nodes_dict[srv], "memory_capacity")
-    report_dict[srv]["CPU requests"] = get_k8s_value(nodes_dict[srv], "cpu_requests")
-    report_dict[srv]["CPU requests percent"] = get_k8s_value(nodes_dict[srv], "cpu_requests_perc")
-    report_dict[srv]["CPU limits"] = get_k8s_value(nodes_dict[srv], "cpu_limits")
-    report_dict[srv]["CPU limits percent"] = get_k8s_value(nodes_dict[srv], "cpu_limits_perc")
-    report_dict[srv]["Memory requests"] = get_k8s_value(nodes_dict[srv], "mem_requests")
-    report_dict[srv]["Memory requests percent"] = get_k8s_value(nodes_dict[srv], "mem_requests_perc")
-    report_dict[srv]["Memory limits"] = get_k8s_value(nodes_dict[srv], "mem_limits")
-    report_dict[srv]["Memory limits percent"] = get_k8s_value(nodes_dict[srv], "mem_limits_perc")
+    # full state from "kubectl get nodes/pods -o json" lists
+    def load(self, nodes_json, pods_json):
+        self.nodes = {}
+        self.pods = {}
+        self.sums = {}
+        for node in nodes_json.get("items", []):
+            self.node_event("ADDED", node)
+        for pod in pods_json.get("items", []):
+            self.pod_event("ADDED", pod)
+
+    # apply a node event, returns the names of the nodes whose row changed
+    def node_event(self, event_type, node):
+        srv = node["metadata"]["name"]
+        if event_type == "DELETED":
+            self.nodes.pop(srv, None)
+        else:
+            self.nodes[srv] = node
+        return {srv}
+
+    # apply a pod event, returns the names of the nodes whose totals changed
+    def pod_event(self, event_type, pod):
+        metadata = pod.get("metadata", {})
+        uid = metadata.get("uid") or "{}/{}".format(metadata.get("namespace"), metadata.get("name"))
+        old = self.pods.get(uid)
+        # events of a pod version we already have (eg. listed just before the watch started) are skipped
+        if old is not None and event_type != "DELETED" and old[1] == metadata.get("resourceVersion"):
+            return set()
+        changed = set()
+        if old is not None:
+            del self.pods[uid]
+            add_totals(self.sums[old[0]], old[2], -1)
+            changed.add(old[0])
+        if event_type != "DELETED" and pod_counted(pod):
+            srv = pod["spec"]["nodeName"]
+            totals = pod_requests_limits(pod)
+            self.pods[uid] = (srv, metadata.get("resourceVersion"), totals)
+            add_totals(self.sums.setdefault(srv, empty_totals()), totals)
+            changed.add(srv)
+        return changed
+
+    # report metrics of a node, None if the node is gone
+    def metrics(self, srv):
+        if srv not in self.nodes:
+            return None
+        return record_metrics(node_record(self.nodes[srv], self.sums.get(srv) or empty_totals()))
+
+# get a list of nodes or pods as JSON with a single kubectl call
+def get_json(kind, timeout):
+    args = ["get", kind, "-o", "json"] + (["--all-namespaces"] if kind == "pods" else [])
+    status, output = run_kubectl(args, timeout)
+    if status != 0:
+        print("kubectl command failed: {}".format(output.strip()), file = sys.stderr)
+        sys.exit(2)
+    return json.loads(output)
+
+# start "kubectl get <kind> --watch-only", its events are JSON documents; without --watch-only
+# kubectl would first replay every object as ADDED, which the list we just loaded already has
+def start_watch(kind):
+    args = ["kubectl", "get", kind, "--watch-only", "--output-watch-events", "-o", "json"]
+    if kind == "pods":
+        args.append("--all-namespaces")
+    return subprocess.Popen(args, stdout = subprocess.PIPE, universal_newlines = True)
+
+# read the events of a watch and put them on the queue as (kind, event), (kind, None) when the
+# watch ends (kubectl watches are closed by the API server from time to time)
+def read_watch(kind, proc, events):
+    decoder = json.JSONDecoder()
+    buffer = ""
+    for line in proc.stdout:
+        buffer += line
+        # documents are pretty printed, one can only end on a line starting with "}" (or be a single line)
+        if not (line.startswith("}") or (line.startswith("{") and line.rstrip().endswith("}"))):
+            continue
+        try:
+            event, end = decoder.raw_decode(buffer.strip())
+        except ValueError:
+            continue
+        buffer = ""
+        events.put((kind, event))
+    proc.wait()
+    events.put((kind, None))
+
+# print the rows of the nodes that changed since we last printed them
+def emit(state, changed, printed, writer):
+    for srv in sorted(changed):
+        metrics = state.metrics(srv)
+        if metrics is None:
+            if printed.pop(srv, None) is not None:
+                print("node {} removed".format(srv), file = sys.stderr)
+        elif printed.get(srv) != metrics:
+            printed[srv] = metrics
+            writer.write(srv, metrics)
+
+# live capacity view: one full table from 2 list calls, then only the rows of the nodes that
+# node/pod events change; when a watch ends we list again (to catch what we missed) and restart it
+# kubectl can't start a watch at the version of a list, so changes made between the list and the
+# start of the watch are only seen at the next resync (or the next event of the same pod/node)
+def run_watch(timeout, writer):
+    state = ClusterState()
+    printed = {}
+    while True:
+        state.load(get_json("nodes", timeout), get_json("pods", timeout))
+        emit(state, set(state.nodes) | set(printed), printed, writer)
+        events = queue.Queue()
+        procs = []
+        try:
+            for kind in ("nodes", "pods"):
+                procs.append(start_watch(kind))
+                threading.Thread(target = read_watch, args = (kind, procs[-1], events), daemon = True).start()
+            while True:
+                kind, event = events.get()
+                if event is None:
+                    print("kubectl {} watch ended, resyncing".format(kind), file = sys.stderr)
+                    break
+                if event.get("type") not in ("ADDED", "MODIFIED", "DELETED"):
+                    continue
+                if kind == "nodes":
+                    changed = state.node_event(event["type"], event["object"])
+                else:
+                    changed = state.pod_event(event["type"], event["object"])
+                emit(state, changed, printed, writer)
+        finally:
+            for proc in procs:
+                if proc.poll() is None:
+                    proc.terminate()
+        time.sleep(watch_retry)
 
 # main function goes here
 def main():
-    # print the nodes and associated metrics in csv format
-    header_line = "Server,CPUs number,Memory capacity(MB),CPU requests,CPU requests percent,CPU limits,\
-        CPU limits percent,Memory requests(MB),Memory requests percent,Memory limits(MB),Memory limits percent"
-    print(header_line)
-    for srv in report_dict.keys():
-        print("{0},{1},{2},{3},{4},{5},{6},{7},{8},{9},{10}".format(srv, report_dict[srv]["CPUs number"], \
-                report_dict[srv]["Memory capacity"], report_dict[srv]["CPU requests"], \
-                report_dict[srv]["CPU requests percent"], report_dict[srv]["CPU limits"], \
-                report_dict[srv]["CPU limits percent"], report_dict[srv]["Memory requests"], \
-                report_dict[srv]["Memory requests percent"], report_dict[srv]["Memory limits"], \
-                report_dict[srv]["Memory limits percent"]))
+    parser = argparse.ArgumentParser(description = "K8S cluster resources allocation report (CSV or JSON lines)")
+    parser.add_argument("-w", "--workers", type = int, default = workers,
+        help = "kubectl describe commands run at once (default: {})".format(workers))
+    parser.add_argument("-t", "--timeout", type = int, default = kubectl_timeout,
+        help = "seconds each kubectl command may take (default: {})".format(kubectl_timeout))
+    parser.add_argument("--cache-file", default = cache_file,
+        help = "cache of the node rows of the previous runs (default: {})".format(cache_file))
+    parser.add_argument("--no-cache", action = "store_true", help = "describe every node, don't read or update the cache")
+    parser.add_argument("-f", "--format", choices = output_formats, default = "csv",
+        help = "output format, rows are written as soon as each node is ready (default: csv)")
+    parser.add_argument("--watch", action = "store_true",
+        help = "keep running and print the rows of the nodes whose allocations change (node/pod watch events)")
+    args = parser.parse_args()
+
+    if args.watch:
+        try:
+            run_watch(args.timeout, RowWriter(args.format))
+        except KeyboardInterrupt:
+            pass
+        return
+
+    # run kubectl command and get list of nodes, then the metrics of each node: nodes whose key
+    # (capacity and pods) is the same as in the cache are written first straight from it, the
+    # others as their describe completes (so rows come in completion order, not node order)
+    node_keys = get_node_keys(args.timeout)
+    cache = {} if args.no_cache else load_cache(args.cache_file)
+    new_cache = {}
+    writer = RowWriter(args.format)
+    to_describe = []
+    for srv, key in node_keys.items():
+        if srv in cache and cache[srv].get("key") == key:
+            new_cache[srv] = cache[srv]
+            writer.write(srv, cache[srv]["metrics"])
+        else:
+            to_describe.append(srv)
+    if not args.no_cache:
+        print("{} node(s) from cache, describing {}".format(len(new_cache), len(to_describe)), file = sys.stderr)
+    failed = []
+    for srv, metrics in describe_nodes(to_describe, max(1, args.workers), args.timeout):
+        if metrics is None:
+            failed.append(srv)
+            continue
+        writer.write(srv, metrics)
+        if not args.no_cache:
+            new_cache[srv] = {"key": node_keys[srv], "metrics": metrics}
+    if not args.no_cache:
+        save_cache(args.cache_file, new_cache)
+    if failed:
+        print("kubectl describe failed for {} node(s): {}".format(len(failed), ", ".join(failed)), file = sys.stderr)
+        sys.exit(2)
 
 if __name__ == '__main__':
     main()
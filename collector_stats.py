@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# Per phase timing and call counting for the K8S collector
+# every phase (SSH/kubectl, parse, Zabbix, DB, file) records its wall time, remote calls and bytes
+# received, nodes record their own time so the slow ones stand out in the JSON summary
+# phases run in several threads at once (SSH sessions, backfill weeks): wall_time is the time at least
+# one thread was in the phase (never more than the run), thread_time the sum of the time of all threads
+# Date: October 2026
+
+import json, statistics, threading, time
+from contextlib import contextmanager
+
+# how many of the slowest nodes we list in the summary
+node_outliers = 10
+
+class RunStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.nodes = {}
+        # {phase: [threads in it, when the first of them entered]}
+        self.active = {}
+
+    def totals(self, phase):
+        return self.phases.setdefault(phase, {"wall_time": 0.0, "thread_time": 0.0, "calls": 0, "bytes": 0})
+
+    # add calls/bytes to a phase (safe to call from several threads)
+    def add(self, phase, calls = 0, nbytes = 0):
+        with self.lock:
+            totals = self.totals(phase)
+            totals["calls"] += calls
+            totals["bytes"] += nbytes
+
+    # time a block of code as part of a phase, blocks of the same phase overlapping in other
+    # threads only count once in its wall time
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        with self.lock:
+            active = self.active.setdefault(name, [0, started])
+            if active[0] == 0:
+                active[1] = started
+            active[0] += 1
+        try:
+            yield
+        finally:
+            ended = time.perf_counter()
+            with self.lock:
+                totals = self.totals(name)
+                totals["thread_time"] += ended - started
+                active = self.active[name]
+                active[0] -= 1
+                if active[0] == 0:
+                    totals["wall_time"] += ended - active[1]
+
+    # callable counting one remote call and the bytes it returned, for the Zabbix client
+    def counter(self, phase):
+        return lambda nbytes: self.add(phase, calls = 1, nbytes = nbytes)
+
+    # time spent on a single node (kubectl describe + parse)
+    def node_time(self, node, seconds):
+        with self.lock:
+            self.nodes[node] = self.nodes.get(node, 0.0) + seconds
+
+    def summary(self):
+        with self.lock:
+            result = {"phases": {name: dict(totals) for name, totals in self.phases.items()}}
+            if self.nodes:
+                times = sorted(self.nodes.values())
+                slowest = sorted(self.nodes.items(), key = lambda node: node[1], reverse = True)[:node_outliers]
+                result["nodes"] = {"count": len(times), "mean": round(statistics.mean(times), 3),
+                    "median": round(statistics.median(times), 3), "max": round(times[-1], 3),
+                    "slowest": [{"node": node, "seconds": round(seconds, 3)} for node, seconds in slowest]}
+        for totals in result["phases"].values():
+            totals["wall_time"] = round(totals["wall_time"], 3)
+            totals["thread_time"] = round(totals["thread_time"], 3)
+        return result
+
+# write the summary of all platforms of a run to a JSON file
+def write_summary(file_name, started, run_stats):
+    summary = {"started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(started)),
+        "total_time": round(time.time() - started, 3),
+        "platforms": {platform: stats.summary() for platform, stats in run_stats.items()}}
+    with open(file_name, "w") as stats_file:
+        json.dump(summary, stats_file, indent = 2, sort_keys = True)
+    return summary
@@ -1,10 +1,12 @@
 #!/usr/bin/env python3
 # Upload K8S resources data to Confluence
+# run on its own it publishes all platforms from the DB, the K8S collector also imports it to
+# publish the section of the platform it just reported straight from memory
 # Date: May 2017
 # Author: Claudiu Tomescu
 # e-mail: klau2005@gmail.com
 
-import sys, requests
+import json, re, sys, threading, requests
 from requests.auth import HTTPBasicAuth
 from datetime import datetime as dt
 import mysql.connector
@@ -18,7 +20,7 @@ headers = {"Content-Type": "application/json"}
 base_url = "<URL>/rest/api/content"
 space_name = "space_name"
 page_name = "page_name"
-page_url = "{}?title={}&spaceKey={}&expand=version".format(base_url, page_name, space_name)
+page_url = "{}?title={}&spaceKey={}&expand=version,body.storage".format(base_url, page_name, space_name)
 platform_dict = {'hsa-gsma': 'HSA GSMA Cluster', 'sca-prd': 'SCA PROD Cluster', 'sca-stg': 'SCA STAGING Cluster'}
 # static HTML table header
 table_header = '<table><tr><th>SERVER</th><th>K8S CPU NUMBER</th><th>K8S CPU LIMITS</th>\
@@ -36,142 +38,129 @@ config = {
   'database': 'k8s',
   'raise_on_warnings': True,
 }
-# date variables
-# get current year/month/day
-curr_year = dt.timetuple(dt.utcnow()).tm_year
-curr_month = dt.timetuple(dt.utcnow()).tm_mon
-curr_day = dt.timetuple(dt.utcnow()).tm_mday
-# transform into date string in format <year>-<month>-<day>
-curr_date = "{}-{}-{}".format(curr_year, curr_month, curr_day)
-# transform into date object (we get clean date, with 00:00 for time, end of report date)
-end_date = dt.strptime(curr_date, '%Y-%m-%d')
-# get report end unixtime from that date object
-end_unixtime = int(dt.strftime(end_date, '%s'))
-# and finally, get unixtime for report start date, 7 days back
-time_diff = 60 * 60 * 24 * hist # get seconds for 7 days back
-start_unixtime = end_unixtime - time_diff
-# get datetime object from start_unixtime (we'll need it to extract start of report week)
-start_date = dt.fromtimestamp(start_unixtime)
-# get report year
-report_year = start_date.isocalendar()[0]
-# get report week number
-report_week = start_date.isocalendar()[1]
-# get report number in <year-week> format (for last week, report week)
-report_number = "{}-{}".format(report_year, report_week)
+# the columns of a table row, in the k8s_report column names
+row_columns = ["server_name", "k8s_cpu_no", "k8s_cpu_limits", "k8s_cpu_limits_perc", "k8s_cpu_requests",
+    "k8s_cpu_requests_perc", "k8s_mem_capacity", "k8s_mem_limits", "k8s_mem_limits_perc", "k8s_mem_requests",
+    "k8s_mem_requests_perc", "total_ram", "available_ram"]
+# the page is read, edited and written back, platforms published at the same time must take turns
+page_lock = threading.Lock()
 
 ### Functions section ###
-# function to create list of servers for certain platform
-def gen_srv_list(platform):
-    srv_list = []
-    query = "SELECT DISTINCT(server_name) FROM k8s_report WHERE platform = '{}'"\
-    .format(platform)
-    cursor.execute(query)
-    for line in cursor:
-        srv_list.append(line[0])
-    return srv_list
+# report number (<year>-<week>) of last week, the week the weekly report covers
+def last_report_number():
+    # get current year/month/day
+    curr_year = dt.timetuple(dt.utcnow()).tm_year
+    curr_month = dt.timetuple(dt.utcnow()).tm_mon
+    curr_day = dt.timetuple(dt.utcnow()).tm_mday
+    # transform into date string in format <year>-<month>-<day>
+    curr_date = "{}-{}-{}".format(curr_year, curr_month, curr_day)
+    # transform into date object (we get clean date, with 00:00 for time, end of report date)
+    end_date = dt.strptime(curr_date, '%Y-%m-%d')
+    # get report end unixtime from that date object
+    end_unixtime = int(dt.strftime(end_date, '%s'))
+    # and finally, get unixtime for report start date, 7 days back
+    time_diff = 60 * 60 * 24 * hist # get seconds for 7 days back
+    start_unixtime = end_unixtime - time_diff
+    # get datetime object from start_unixtime (we'll need it to extract start of report week)
+    start_date = dt.fromtimestamp(start_unixtime)
+    # get report number in <year-week> format (for last week, report week)
+    return "{}-{}".format(start_date.isocalendar()[0], start_date.isocalendar()[1])
 
-# function to get data from DB for certain server/platform
-def k8s_data(platform, srv):
-    # define SELECT query
-    query = "SELECT server_name, k8s_cpu_no, k8s_cpu_limits,\
-    k8s_cpu_limits_perc, k8s_cpu_requests, k8s_cpu_requests_perc,\
-    k8s_mem_capacity, k8s_mem_limits, k8s_mem_limits_perc,\
-    k8s_mem_requests, k8s_mem_requests_perc,\
-    total_ram, available_ram FROM k8s_report WHERE report_week = '{0}'\
-    AND platform = '{1}' AND server_name = '{2}' LIMIT 1".format(report_number, platform, srv)
-    # run query in DB and store result in tuple
-    cursor.execute(query)
-    for line in cursor:
-        result = line
-    return result
+# open connection to DB
+def db_connect():
+    try:
+        return mysql.connector.connect(**config)
+    except mysql.connector.Error as err:
+        if err.errno == errorcode.ER_ACCESS_DENIED_ERROR:
+            print("Something is wrong with your user name or password")
+            sys.exit(2)
+        elif err.errno == errorcode.ER_BAD_DB_ERROR:
+            print("Database does not exist")
+            sys.exit(2)
+        else:
+            print(err)
+            sys.exit(2)
+
+# get the table rows (row_columns order) of a platform and week from the DB with a single query
+def db_rows(cursor, platform, report_number):
+    query = "SELECT {} FROM k8s_report WHERE report_week = %s AND platform = %s ORDER BY server_name".format(
+        ", ".join(row_columns))
+    cursor.execute(query, (report_number, platform))
+    return list(cursor)
 
-# function to create update data for Confluence
-def gen_data(list):
+# function to create update data for Confluence, one HTML table row per server
+def gen_data(rows):
     table_data = ""
-    for srv in list:
-        server = k8s_data(platform, srv)[0]
-        cpu_no = k8s_data(platform, srv)[1]
-        cpu_limits = k8s_data(platform, srv)[2]
-        cpu_limits_perc = k8s_data(platform, srv)[3]
-        cpu_requests = k8s_data(platform, srv)[4]
-        cpu_requests_perc = k8s_data(platform, srv)[5]
-        mem_capacity = k8s_data(platform, srv)[6]
-        mem_limits = k8s_data(platform, srv)[7]
-        mem_limits_perc = k8s_data(platform, srv)[8]
-        mem_requests = k8s_data(platform, srv)[9]
-        mem_requests_perc = k8s_data(platform, srv)[10]
-        total_ram = k8s_data(platform, srv)[11]
-        available_ram = k8s_data(platform, srv)[12]
-        # format data to be used in the request
-        row_data = '<tr><td>{0}</td><td>{1}</td><td>{2}</td><td>{3}</td><td>{4}</td>\
-        <td>{5}</td><td>{6}</td><td>{7}</td><td>{8}</td><td>{9}</td><td>{10}</td>\
-        <td>{11}</td><td>{12}</td></tr>'.format(server, cpu_no, cpu_limits,\
-        cpu_limits_perc, cpu_requests, cpu_requests_perc, mem_capacity, mem_limits,\
-        mem_limits_perc, mem_requests, mem_requests_perc, total_ram, available_ram)
-        table_data += row_data
+    for row in rows:
+        table_data += "<tr>{}</tr>".format("".join("<td>{}</td>".format(value) for value in row))
     return table_data
 
-### DB section ###
-# open connection to DB
-try:
-    cnx = mysql.connector.connect(**config)
-    cursor = cnx.cursor()
-except mysql.connector.Error as err:
-    if err.errno == errorcode.ER_ACCESS_DENIED_ERROR:
-        print("Something is wrong with your user name or password")
-        sys.exit(2)
-    elif err.errno == errorcode.ER_BAD_DB_ERROR:
-        print("Database does not exist")
-        sys.exit(2)
-    else:
-        print(err)
-        sys.exit(2)
-
-# define variable that will store data to be uploaded to Confluence
-confluence_data = ""
+# title, header, rows and footer of a platform section of the page
+def platform_section(platform, rows):
+    return '<h2>{}</h2>{}{}{}'.format(platform_dict.get(platform, platform), table_header, gen_data(rows), table_footer)
 
-# function to populate confluence variable with needed data
-for platform in platform_dict.keys():
-    confluence_data += '<h2>{}</h2>'.format(platform_dict[platform])
-    confluence_data += table_header
-    srv_list = gen_srv_list(platform)
-    confluence_data += gen_data(srv_list)
-    confluence_data += table_footer
+# replace the section of a platform in the page body, or add it at the end if the page doesn't have it yet
+def replace_section(body, platform, section):
+    title = re.escape('<h2>{}</h2>'.format(platform_dict.get(platform, platform)))
+    match = re.search(title + '.*?' + re.escape(table_footer), body, re.S)
+    if match is None:
+        return body + section
+    return body[:match.start()] + section + body[match.end():]
 
 ### Confluence API section ###
-# connect to API and get page ID and page version
-try:
-    response = requests.get(page_url, auth = HTTPBasicAuth(api_user, api_passwd))
-except Exception as e:
-    print(e)
-    print("Cannot connect to Confluence, please check site/link")
-    sys.exit(2)
-else:
-    if response.status_code == 200:
-        page_id = response.json()['results'][0]['id']
-        page_ver = response.json()['results'][0]['version']['number']
-        update_data = '{{"id": "{ID}", "status": "current", "version": {{"number": {version}}},\
-        "space": {{"key": "{space}"}}, "type": "page", "title": "{page}", "body": {{"storage": {{\
-        "value": "{data}", "representation": "storage"}}}}}}'.format(ID = page_id, \
-        version = page_ver + 1, space = space_name, page = page_name, data = confluence_data)
-    else:
+# connect to API and get page ID, page version and current content
+def get_page():
+    try:
+        response = requests.get(page_url, auth = HTTPBasicAuth(api_user, api_passwd))
+    except Exception as e:
+        print(e)
+        print("Cannot connect to Confluence, please check site/link")
+        sys.exit(2)
+    if response.status_code != 200:
         print("Something went wrong, exiting...")
         sys.exit(2)
+    page = response.json()['results'][0]
+    return page['id'], page['version']['number'], page['body']['storage']['value']
 
-# define Confluence page URL    
-update_url = "{}/{}".format(base_url, page_id)
-
-try:
-    response = requests.put(update_url, update_data, headers = headers, auth = HTTPBasicAuth(api_user, api_passwd))
-except Exception as e:
-    print(e)
-    print("Cannot connect to Confluence, please check site/link")
-    sys.exit(2)
-else:
-    if response.status_code == 200:
-        print("Data successfully uploaded!")
-        sys.exit(0)
-    else:
+# write the new page content as the next version of the page
+def update_page(page_id, page_ver, confluence_data):
+    update_data = json.dumps({"id": page_id, "status": "current", "version": {"number": page_ver + 1},
+        "space": {"key": space_name}, "type": "page", "title": page_name,
+        "body": {"storage": {"value": confluence_data, "representation": "storage"}}})
+    # define Confluence page URL
+    update_url = "{}/{}".format(base_url, page_id)
+    try:
+        response = requests.put(update_url, update_data, headers = headers, auth = HTTPBasicAuth(api_user, api_passwd))
+    except Exception as e:
+        print(e)
+        print("Cannot connect to Confluence, please check site/link")
+        sys.exit(2)
+    if response.status_code != 200:
         print(response.json())
         print("Something went wrong, exiting...")
         sys.exit(2)
+
+# replace only the section of one platform on the page (rows in row_columns order), the other
+# platforms keep what they have
+def publish_platform(platform, rows):
+    with page_lock:
+        page_id, page_ver, body = get_page()
+        update_page(page_id, page_ver, replace_section(body, platform, platform_section(platform, rows)))
+
+# publish all platforms of last week from the DB
+def main():
+    report_number = last_report_number()
+    cnx = db_connect()
+    cursor = cnx.cursor()
+    # define variable that will store data to be uploaded to Confluence
+    confluence_data = ""
+    for platform in platform_dict.keys():
+        confluence_data += platform_section(platform, db_rows(cursor, platform, report_number))
+    cursor.close()
+    cnx.close()
+    page_id, page_ver, body = get_page()
+    update_page(page_id, page_ver, confluence_data)
+    print("Data successfully uploaded!")
+
+if __name__ == '__main__':
+    main()
@@ -5,35 +5,120 @@
 # Author: Claudiu Tomescu
 # e-mail: klau2005@gmail.com
 
-import re, sys, requests
+import argparse, configparser, json, os, queue, re, signal, sys, time, requests
+from array import array
+import pexpect
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from pexpect import pxssh
-from datetime import datetime as dt
-import mysql.connector
+from datetime import datetime as dt, timedelta
+import mysql.connector, mysql.connector.pooling
 from mysql.connector import errorcode
+from k8s_resources import NodeRecord, conv_cpu_val, parse_node_describe, parse_nodes_json, parse_quantity
+from zabbix_client import ZabbixClient, ZabbixError
+from zabbix_history_cache import HistoryCache
+from collector_stats import RunStats, write_summary
+from snapshot_store import SnapshotStore
+import confluence_upload
+from raw_archive import RawArchive, KubectlRecorder, RecordingSession, RecordingClient, ReplayClient, build_manifest
+from quantile_sketch import LogHistogram
+# NumPy is optional: with it the raw history of all items is aggregated in one vectorized pass
+# (exact percentiles), without it every sample goes through a quantile sketch
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-def usage():
-    print("Usage {} <sca-prd|sca-stg>".format(sys.argv[0]))
-    sys.exit(1)
-
-if len(sys.argv) != 2:
-    usage()
-
-###FIRST STEP - K8S DATA###
-# variables for k8s connection
-platform = sys.argv[1]
-if platform == "sca-stg":
-    k8s_hostname = '<IP>'
-    report_file = "/home/claudtom/scripts/k8s_weekly_report_sca_stg"
-elif platform == "sca-prd":
-    k8s_hostname = '<IP>'
-    report_file = "/home/claudtom/scripts/k8s_weekly_report_sca_prd"
-else:
-    usage()
+# variables for k8s connection, per platform
+platforms = {
+    "sca-stg": {"k8s_hostname": '<IP>', "report_file": "/home/claudtom/scripts/k8s_weekly_report_sca_stg"},
+    "sca-prd": {"k8s_hostname": '<IP>', "report_file": "/home/claudtom/scripts/k8s_weekly_report_sca_prd"},
+}
 
 # define history variable (how many days of history to extract from Zabbix)
 hist = 7
 # k8s master node username and password
 k8s_username = '<ssh_username>'
+# number of concurrent SSH sessions used to describe the nodes and seconds we wait for each node
+ssh_sessions = 8
+node_timeout = 60
+
+# variables for Zabbix API connection
+zabbix_url = '<zabbix_url>/api_jsonrpc.php'
+zabbix_username = 'zabbix_api_user'
+zabbix_password = 'password'
+
+# Zabbix items we report on, the key is also the base name of the report value (tot_mem_id -> tot_mem_avg)
+memory_items = {"tot_mem_id": "vm.memory.size[total]", "avail_mem_id": "vm.memory.size[available]"}
+# weekly stats we compute for every item: average, exact min/max and streaming percentile estimates
+ram_stats = ("avg", "min", "max", "p50", "p95", "p99")
+
+# JSON summary of the run (time, remote calls and bytes per phase, slowest nodes)
+stats_file = "/home/claudtom/scripts/k8s_collector_stats_{}.json"
+
+# columnar store every report week is also written to (one typed array per metric, see snapshot_store.py)
+snapshot_dir = "/home/claudtom/scripts/k8s_snapshots"
+# NodeRecord columns of the store and their array type (percents and CPUs may come with decimals)
+snapshot_columns = {"cpus_number": "d", "memory_capacity": "q", "cpu_requests": "q", "cpu_requests_perc": "d",
+    "cpu_limits": "q", "cpu_limits_perc": "d", "mem_requests": "q", "mem_requests_perc": "d", "mem_limits": "q",
+    "mem_limits_perc": "d"}
+
+# archive of the raw kubectl outputs and Zabbix responses of every run, so past weeks can be reprocessed
+archive_dir = "/home/claudtom/scripts/k8s_raw_archive"
+
+# node label whose values define the node pools of the rollups (nodes without it go to "<none>")
+pool_label = "nodepool"
+
+# how many Zabbix calls we run at once and how many weeks of a backfill we report in parallel
+zabbix_workers = 8
+backfill_workers = 4
+
+# daemon mode: seconds between two allocation samples and between two DB flushes of the aggregates
+sample_interval = 300
+flush_interval = 3600
+
+# define DB parameters
+config = {
+  'user': 'db_user',
+  'password': 'db_pass',
+  'host': 'db_host',
+  'database': 'k8s',
+  'raise_on_warnings': True,
+}
+# DB connection pool, set up by open_db_pool() when several platforms or weeks are reported at once
+db_pool = None
+# columns of the k8s_report table we fill, in the order report_rows() builds them
+report_columns = ["report_week", "platform", "server_name", "k8s_cpu_no", "k8s_cpu_limits", "k8s_cpu_limits_perc",
+    "k8s_cpu_requests", "k8s_cpu_requests_perc", "k8s_mem_capacity", "k8s_mem_limits", "k8s_mem_limits_perc",
+    "k8s_mem_requests", "k8s_mem_requests_perc", "total_ram", "available_ram", "available_ram_min",
+    "available_ram_p50", "available_ram_p95", "available_ram_p99"]
+# the available RAM min/percentiles columns were added later:
+# ALTER TABLE k8s_report ADD COLUMN available_ram_min INT, ADD COLUMN available_ram_p50 INT,
+#     ADD COLUMN available_ram_p95 INT, ADD COLUMN available_ram_p99 INT;
+# rows are unique per (report_week, platform, server_name) so a rerun or backfill updates the week
+# instead of adding duplicates, this needs the unique key on the table:
+# ALTER TABLE k8s_report ADD UNIQUE KEY report_server (report_week, platform, server_name);
+upsert_query = "INSERT INTO k8s_report ({}) VALUES ({}) ON DUPLICATE KEY UPDATE {}".format(
+    ", ".join(report_columns), ", ".join(["%s"] * len(report_columns)),
+    ", ".join("{0} = VALUES({0})".format(col) for col in report_columns[3:]))
+# weekly streaming aggregates of the daemon, one row per server and NodeRecord metric:
+# CREATE TABLE k8s_alloc_aggregate (report_week VARCHAR(8), platform VARCHAR(16), server_name VARCHAR(64),
+#   metric VARCHAR(32), samples INT, avg_value DOUBLE, max_value DOUBLE, last_value DOUBLE,
+#   UNIQUE KEY aggregate_metric (report_week, platform, server_name, metric));
+aggregate_upsert_query = "INSERT INTO k8s_alloc_aggregate (report_week, platform, server_name, metric, samples, \
+avg_value, max_value, last_value) VALUES (%s, %s, %s, %s, %s, %s, %s, %s) ON DUPLICATE KEY UPDATE \
+samples = VALUES(samples), avg_value = VALUES(avg_value), max_value = VALUES(max_value), last_value = VALUES(last_value)"
+aggregate_select_query = "SELECT server_name, metric, samples, avg_value, max_value, last_value \
+FROM k8s_alloc_aggregate WHERE report_week = %s AND platform = %s"
+# per namespace and per node pool allocation rollups, kind is "namespace" or "pool" (capacity only for pools):
+# CREATE TABLE k8s_rollup (report_week VARCHAR(8), platform VARCHAR(16), kind VARCHAR(16), name VARCHAR(128),
+#   nodes INT, pods INT, cpu_capacity INT, cpu_requests INT, cpu_limits INT, mem_capacity INT, mem_requests INT,
+#   mem_limits INT, UNIQUE KEY rollup_name (report_week, platform, kind, name));
+rollup_columns = ["report_week", "platform", "kind", "name", "nodes", "pods", "cpu_capacity", "cpu_requests",
+    "cpu_limits", "mem_capacity", "mem_requests", "mem_limits"]
+rollup_upsert_query = "INSERT INTO k8s_rollup ({}) VALUES ({}) ON DUPLICATE KEY UPDATE {}".format(
+    ", ".join(rollup_columns), ", ".join(["%s"] * len(rollup_columns)),
+    ", ".join("{0} = VALUES({0})".format(col) for col in rollup_columns[4:]))
 
 # define various functions
 # standardize all hostnames into caps and no smctr.net format
@@ -43,294 +128,1049 @@ def normalize_name(hostname):
     hostname = hostname.upper()
     return hostname
 
-# convert full CPU resource value from k8s into milicpu format (eg. from 1 to 1000)
-def conv_cpu_val(val):
-    if not "m" in val:
-        result = int(val) * 1000
-    else:
-        result = int(val.strip("m"))
-    return result
-
-# convert memory resource value from k8s from KB/GB into MB (eg. from 4046588Ki to 3951 or from 2Gi to 2048Mi)
-def conv_mem_val(val):
-    if "K" in val:
-        result = int(val.strip("Ki")) // 1024
-    elif "G" in val:
-        result = int(val.strip("Gi")) * 1024
-    else:
-        result = int(val.strip("Mi"))
-    return result
-
-# create function to extract metrics from k8s raw data
-def get_k8s_value(data, metric):
-    i = 0
-    while i < len(data)-3: # we don't go further as this is the last line we care about
-        # search for the line that contains "Capacity:" to get CPU and memory allocated
-        if re.match("^ *Capacity:", data[i]):
-            # if we need CPUs number, search for the second line after the match
-            if metric == "cpus_number":
-                metric_line = i+2
-                value = data[metric_line].split("\\t")[-1]
-            # if we need memory size, search for the third line after the match
-            elif metric == "memory_capacity":
-                metric_line = i+3
-                value = conv_mem_val(data[metric_line].split("\\t")[-1])
-        # search for the line that starts with "CPU Requests" to get resource usage
-        elif re.match("^ *CPU Requests", data[i]):
-            metric_line = i+2
-            if metric == "cpu_requests":
-                value = conv_cpu_val(data[metric_line].split()[0])
-            elif metric == "cpu_requests_perc":
-                value = data[metric_line].split()[1].split("\\t")[0].strip("()").strip("%")
-            elif metric == "cpu_limits":
-                value = conv_cpu_val(data[metric_line].split()[1].split("\\t")[-1])
-            elif metric == "cpu_limits_perc":
-                value = data[metric_line].split()[2].split("\\t")[0].strip("()").strip("%")
-            elif metric == "mem_requests":
-                value = conv_mem_val(data[metric_line].split()[2].split("\\t")[-1])
-            elif metric == "mem_requests_perc":
-                value = data[metric_line].split()[3].split("\\t")[0].strip("()").strip("%")
-            elif metric == "mem_limits":
-                value = conv_mem_val(data[metric_line].split()[3].split("\\t")[-1])
-            elif metric == "mem_limits_perc":
-                value = data[metric_line].split()[4].strip("()").strip("%")
-        i+=1
-    return value
-
 # convert RAM value from B to MB
 def bytes_to_mbytes(val):
     result = int(val) // 1024 // 1024
     return result
 
-# function to calculate average value from zabbix history data
-# we do this as trends.get API call fails so we use history.get call
-# please share with me if you make it work for non-float items
-def get_average(data):
-    # create empty list to hold all history values
-    value_list = []
-    # populate list with values (ints)
-    for item in data:
-        value_list.append(int(item['value']))
-    # calculate average and return value
-    average_val = sum(value_list) // len(value_list) if len(value_list) != 0 else 0
-    return average_val
-
-# define empty dictionary to store nodes and raw metrics from kubectl describe command
-nodes_dict = {}
-# create dictionary for storing final data to generate report from
-report_dict = {}
-
-print("Running kubectl commands on {} cluster to get nodes/stats...".format(sys.argv[1]))
-# connect through SSH and run kubectl command to get nodes/stats from cluster
+# weekly stats (see ram_stats) of an item from its hourly trends: each hour carries the number of
+# samples and their avg/min/max, so the hourly average goes in the sketch weighted by its samples
+# (percentiles are then those of the hourly averages) and min/max stay exact
+def get_trends_stats(data):
+    sketch = LogHistogram()
+    for hour in data:
+        sketch.add(float(hour['value_avg']), int(hour['num']))
+        sketch.widen(float(hour['value_min']), float(hour['value_max']))
+    return sketch.stats()
+
+# open the SSH session to the k8s master
 # this assumes we have a passwordless SSH key in standard location, like .ssh/id_rsa
 # if the key is protected by a password, we must suply 3rd parameter to login function
 # ex. s.login(k8s_hostname, k8s_username, k8s_passwd), where k8s_passwd is the key password
-try:
-    s = pxssh.pxssh()
+def ssh_connect(k8s_hostname):
+    # bigger read chunks and a bounded search window keep pexpect fast on multi-MB JSON outputs
+    s = pxssh.pxssh(maxread = 65536, searchwindowsize = 4096)
     s.login(k8s_hostname, k8s_username)
-    s.sendline("kubectl get no | awk '!/NAME/{print $1}'") # get nodes
+    return s
+
+# everything a command printed (raw session output), without the echoed command line
+def command_output(raw):
+    output = raw.decode("utf-8", "replace")
+    return output.split("\r\n", 1)[1] if "\r\n" in output else ""
+
+# run a command on the k8s master and return everything it printed, without the echoed command line
+def run_remote(s, comm, stats):
+    s.sendline(comm)
     s.prompt() # match the prompt
-    nodes = str(s.before) # print everything before the prompt.
-    # save the nodes in the report dictionary as keys
-    for srv in nodes.split("\\r\\n")[1:-1]:
-        report_dict[srv] = {}
-    # iterate over nodes list and get metrics for each using kubectl describe command
-    for srv in report_dict.keys():
-        comm = "kubectl describe no {}".format(srv)
-        s.sendline(comm)
-        s.prompt()
-        # fill nodes dictionary with {"host": ["raw_values"]} data
-        nodes_dict[srv] = str(s.before).split("\\r\\n")
-    s.logout()
-except pxssh.ExceptionPxssh as e:
-    print("pxssh failed on login.")
-    print(e)
-    sys.exit(2)
-
-print("Success")
-
-# populate report dictionary with needed metrics
-for srv in nodes_dict.keys():
-    report_dict[srv]["CPUs number"] = get_k8s_value(nodes_dict[srv], "cpus_number")
-    report_dict[srv]["Memory capacity"] = get_k8s_value(nodes_dict[srv], "memory_capacity")
-    report_dict[srv]["CPU requests"] = get_k8s_value(nodes_dict[srv], "cpu_requests")
-    report_dict[srv]["CPU requests percent"] = get_k8s_value(nodes_dict[srv], "cpu_requests_perc")
-    report_dict[srv]["CPU limits"] = get_k8s_value(nodes_dict[srv], "cpu_limits")
-    report_dict[srv]["CPU limits percent"] = get_k8s_value(nodes_dict[srv], "cpu_limits_perc")
-    report_dict[srv]["Memory requests"] = get_k8s_value(nodes_dict[srv], "mem_requests")
-    report_dict[srv]["Memory requests percent"] = get_k8s_value(nodes_dict[srv], "mem_requests_perc")
-    report_dict[srv]["Memory limits"] = get_k8s_value(nodes_dict[srv], "mem_limits")
-    report_dict[srv]["Memory limits percent"] = get_k8s_value(nodes_dict[srv], "mem_limits_perc")
-
-# at this step, we are done with k8s processing so we delete unused dictionary
-del nodes_dict
-
-###SECOND STEP - ZABBIX DATA###
-# variables for Zabbix API connection
-zabbix_url = '<zabbix_url>/api_jsonrpc.php'
-headers = {"Content-Type": "application/json"}
-zabbix_username = 'zabbix_api_user'
-zabbix_password = 'password'
-zabbix_auth_req = '{{"jsonrpc": "2.0", "method": "user.login", "params": {{"user": "{}", \
-"password": "{}"}}, "id": 1, "auth": null}}'.format(zabbix_username, zabbix_password)
-zabbix_auth_req = zabbix_auth_req.encode()
-
-# get current year/month/day
-curr_year = dt.timetuple(dt.utcnow()).tm_year
-curr_month = dt.timetuple(dt.utcnow()).tm_mon
-curr_day = dt.timetuple(dt.utcnow()).tm_mday
-# transform into date string in format <year>-<month>-<day>
-curr_date = "{}-{}-{}".format(curr_year, curr_month, curr_day)
-# transform into date object (we get clean date, with 00:00 for time, end of report date)
-end_date = dt.strptime(curr_date, '%Y-%m-%d')
-# get report end unixtime from that date object
-end_unixtime = int(dt.strftime(end_date, '%s'))
-# and finally, get unixtime for report start date, 7 days back
-time_diff = 60 * 60 * 24 * hist # get seconds for 7 days back
-start_unixtime = end_unixtime - time_diff
-# get datetime object from start_unixtime (we'll need it to extract start of report week)
-start_date = dt.fromtimestamp(start_unixtime)
-# get report year
-report_year = start_date.isocalendar()[0]
-# get report week number
-report_week = start_date.isocalendar()[1]
-# get report number in <year-week> format (for last week, report week)
-report_number = "{}-{}".format(report_year, report_week)
-
-print("Connect to Zabbix API to get metrics...")
-# start getting data from Zabbix API
-# first get connection token
-response = requests.post(zabbix_url, zabbix_auth_req, headers = headers)
-token = response.json()['result']
-
-# create dictionary to store different values from Zabbix (hostid, itemid)
-zabbix_dict = {}
-
-for srv in report_dict.keys():
-    zabbix_dict[srv] = {}
-
-# get and store item ids for total memory and available memory
-for srv in report_dict.keys():
-    tot_mem_id_req = '{{"jsonrpc": "2.0", "method": "item.get", "params": {{"output": "itemid", "host": "{}", \
-    "search": {{"key_": "vm.memory.size[total]"}},  "sortfield": "name"}}, "auth": "{}", "id": 1}}'.format(srv, token)
-    result = requests.post(zabbix_url, tot_mem_id_req, headers = headers).json()['result'][0]['itemid']
-    zabbix_dict[srv]["tot_mem_id"] = result
-
-for srv in report_dict.keys():
-    avail_mem_id_req = '{{"jsonrpc": "2.0", "method": "item.get", "params": {{"output": "itemid", "host": "{}", \
-    "search": {{"key_": "vm.memory.size[available]"}},  "sortfield": "name"}}, "auth": "{}", "id": 1}}'.format(srv, token)
-    result = requests.post(zabbix_url, avail_mem_id_req, headers = headers).json()['result'][0]['itemid']
-    zabbix_dict[srv]["avail_mem_id"] = result
-
-# add Zabbix history values for total and available memory to report dictionary
-for srv in zabbix_dict.keys():
-    print("Getting data for {}...".format(srv))
-    for item in zabbix_dict[srv].keys():
-        item_id = zabbix_dict[srv][item]
-        hist_req = '{{"jsonrpc": "2.0", "method": "history.get", "params": {{"output": "extend", "history": 3, "itemids": "{}", \
-        "time_from": "{}", "time_till": "{}"}}, "auth": "{}", "id": 1}}'.format(item_id, start_unixtime, end_unixtime, token)
-        avg_value = requests.post(zabbix_url, hist_req, headers = headers).json()['result']
-        avg_value = get_average(avg_value)
-        # define new dictionary keys named <item_name_avg> (for eg. tot_mem_avg)
-        item_name = item.rstrip("id") + "avg"
-        report_dict[srv][item_name] = bytes_to_mbytes(avg_value)
-    print("done")
-
-print("Success")
-
-print("Adding data to DB...")
-
-###THIRD STEP - DB###
-# define DB parameters
-config = {
-  'user': 'db_user',
-  'password': 'db_pass',
-  'host': 'db_host',
-  'database': 'k8s',
-  'raise_on_warnings': True,
-}
+    stats.add("ssh", calls = 1, nbytes = len(s.before))
+    return command_output(s.before)
+
+# command listing the nodes of the cluster and the node names in its raw output
+nodes_comm = "kubectl get no | awk '!/NAME/{print $1}'"
+def parse_nodes(raw):
+    nodes = str(raw) # print everything before the prompt.
+    return nodes.split("\\r\\n")[1:-1]
+
+# get the list of nodes of the cluster
+def get_nodes(s, stats):
+    s.sendline(nodes_comm) # get nodes
+    s.prompt() # match the prompt
+    stats.add("ssh", calls = 1, nbytes = len(s.before))
+    return parse_nodes(s.before)
+
+# parse the raw kubectl describe output of a node (bytes, as the session returned it)
+# returns (NodeRecord, NodeDetail)
+def parse_describe(raw):
+    return parse_node_describe(raw.decode("utf-8", "replace").split("\r\n"))
+
+# run kubectl describe for one node and parse it, returns (NodeRecord, NodeDetail)
+# or (None, None) if the node missed its deadline
+def describe_node(s, srv, node_timeout, stats):
+    started = time.perf_counter()
+    comm = "kubectl describe no {}".format(srv)
+    s.sendline(comm)
+    if not s.prompt(timeout = node_timeout):
+        stats.node_time(srv, time.perf_counter() - started)
+        return None, None
+    stats.add("ssh", calls = 1, nbytes = len(s.before))
+    # parse the raw values straight away, we don't need to keep them around
+    with stats.phase("parse"):
+        record, detail = parse_describe(s.before)
+    stats.node_time(srv, time.perf_counter() - started)
+    return record, detail
+
+# run kubectl describe for every node through a pool of concurrent SSH sessions
+# (wrapped to archive what they get when a recorder is given)
+# returns ({"host": NodeRecord}, {"host": NodeDetail}, [nodes that timed out or failed])
+def collect_describe(k8s_hostname, nodes, sessions, node_timeout, stats, recorder = None):
+    def connect():
+        s = ssh_connect(k8s_hostname)
+        return RecordingSession(s, recorder) if recorder is not None else s
+
+    report_dict = dict.fromkeys(nodes)
+    details = {}
+    failed = []
+    pool = queue.Queue()
+    # log in all sessions in parallel, a slow handshake shouldn't delay the others
+    # a session that can't log in leaves a None slot (reopened on use), we only give up without any
+    def try_connect(i):
+        try:
+            return connect(), None
+        except (pxssh.ExceptionPxssh, pexpect.EOF) as e:
+            print("Cannot open SSH session: {}".format(e))
+            return None, e
+    errors = []
+    with ThreadPoolExecutor(max_workers = sessions) as executor:
+        for s, error in executor.map(try_connect, range(sessions)):
+            pool.put(s)
+            if error is not None:
+                errors.append(error)
+    if len(errors) == sessions:
+        raise errors[0]
+
+    def worker(srv):
+        s = pool.get()
+        # a None slot means that session was lost earlier, try to reopen it
+        if s is None:
+            try:
+                s = connect()
+            except pxssh.ExceptionPxssh as e:
+                print("Cannot reopen SSH session: {}".format(e))
+                pool.put(None)
+                return srv, None, None
+        try:
+            record, detail = describe_node(s, srv, node_timeout, stats)
+        except (pxssh.ExceptionPxssh, pexpect.EOF) as e:
+            record = detail = None
+            print("kubectl describe failed for {}: {}".format(srv, e))
+        if record is None:
+            # the session is still busy with (or lost) the old command, drop it and reopen on next use
+            s.close()
+            s = None
+        pool.put(s)
+        return srv, record, detail
+
+    with ThreadPoolExecutor(max_workers = sessions) as executor:
+        for srv, record, detail in executor.map(worker, nodes):
+            report_dict[srv] = record
+            if record is None:
+                failed.append(srv)
+            else:
+                details[srv] = detail
+    while not pool.empty():
+        s = pool.get()
+        if s is not None:
+            s.logout()
+    return report_dict, details, failed
+
+# commands of the JSON mode: all nodes and all pods
+json_comms = ("kubectl get nodes -o json", "kubectl get pods --all-namespaces -o json")
+
+# decode the JSON document a command printed (skipping anything the shell printed before it)
+def decode_output(comm, output):
+    start = output.find("{")
+    if start == -1:
+        raise ValueError("'{}' returned no JSON: {}".format(comm, output.strip()[:200]))
+    return json.JSONDecoder().raw_decode(output, start)[0]
+
+# get all nodes and all pods as JSON (2 remote calls whatever the cluster size)
+# and compute the per node allocations locally, returns ({"host": NodeRecord}, {"host": NodeDetail})
+def collect_json(s, stats):
+    result = []
+    for comm in json_comms:
+        output = run_remote(s, comm, stats)
+        with stats.phase("parse"):
+            result.append(decode_output(comm, output))
+    with stats.phase("parse"):
+        return parse_nodes_json(result[0], result[1])
+
+# connect through SSH and run kubectl commands to get nodes/stats from cluster
+# the "ssh" phase time is the wall time of the whole step, parsing included (it runs as outputs come in)
+# the raw outputs are archived through recorder (a KubectlRecorder) if one is given
+# returns ({"host": NodeRecord}, {"host": NodeDetail}, [nodes that timed out or failed])
+def collect_k8s(platform, args, stats = None, recorder = None):
+    stats = stats or RunStats()
+    k8s_hostname = platforms[platform]["k8s_hostname"]
+    with stats.phase("ssh"):
+        s = ssh_connect(k8s_hostname)
+        if recorder is not None:
+            s = RecordingSession(s, recorder)
+        if args.json:
+            report_dict, details = collect_json(s, stats)
+            s.logout()
+            return report_dict, details, []
+        nodes = get_nodes(s, stats)
+        s.logout()
+        return collect_describe(k8s_hostname, nodes, max(1, args.sessions), args.node_timeout, stats, recorder)
+
+# rebuild the K8S data of a collection from the archived kubectl outputs (see collect_k8s)
+# returns ({"host": NodeRecord}, {"host": NodeDetail}, [nodes without archived data])
+def archived_k8s(recorder, mode, stats):
+    with stats.phase("parse"):
+        if mode == "json":
+            result = []
+            for comm in json_comms:
+                raw = recorder.output(comm)
+                if raw is None:
+                    raise ValueError("'{}' output not in the archive".format(comm))
+                result.append(decode_output(comm, command_output(raw)))
+            report_dict, details = parse_nodes_json(result[0], result[1])
+            return report_dict, details, []
+        raw = recorder.output(nodes_comm)
+        if raw is None:
+            raise ValueError("node list not in the archive")
+        report_dict = {}
+        details = {}
+        failed = []
+        for srv in parse_nodes(raw):
+            raw = recorder.output("kubectl describe no {}".format(srv))
+            report_dict[srv], detail = parse_describe(raw) if raw is not None else (None, None)
+            if report_dict[srv] is None:
+                failed.append(srv)
+            else:
+                details[srv] = detail
+        return report_dict, details, failed
+
+# compute the report time frame: the "hist" days before today's midnight
+# returns (start_unixtime, end_unixtime, report_number)
+def report_dates():
+    # get current year/month/day
+    curr_year = dt.timetuple(dt.utcnow()).tm_year
+    curr_month = dt.timetuple(dt.utcnow()).tm_mon
+    curr_day = dt.timetuple(dt.utcnow()).tm_mday
+    # transform into date string in format <year>-<month>-<day>
+    curr_date = "{}-{}-{}".format(curr_year, curr_month, curr_day)
+    # transform into date object (we get clean date, with 00:00 for time, end of report date)
+    end_date = dt.strptime(curr_date, '%Y-%m-%d')
+    # get report end unixtime from that date object
+    end_unixtime = int(dt.strftime(end_date, '%s'))
+    # and finally, get unixtime for report start date, 7 days back
+    time_diff = 60 * 60 * 24 * hist # get seconds for 7 days back
+    start_unixtime = end_unixtime - time_diff
+    # get datetime object from start_unixtime (we'll need it to extract start of report week)
+    start_date = dt.fromtimestamp(start_unixtime)
+    # get report year
+    report_year = start_date.isocalendar()[0]
+    # get report week number
+    report_week = start_date.isocalendar()[1]
+    # get report number in <year-week> format (for last week, report week)
+    report_number = "{}-{}".format(report_year, report_week)
+    return start_unixtime, end_unixtime, report_number
+
+# time frame of an ISO week, from Monday 00:00 to the next Monday 00:00 (local time, like report_dates())
+# returns (start_unixtime, end_unixtime, report_number)
+def week_dates(year, week):
+    start_date = dt.fromisocalendar(year, week, 1)
+    start_unixtime = int(time.mktime(start_date.timetuple()))
+    end_unixtime = int(time.mktime((start_date + timedelta(days = hist)).timetuple()))
+    return start_unixtime, end_unixtime, "{}-{}".format(year, week)
+
+# list of week time frames for a "<year>-<week>[:<year>-<week>]" range (same format as report_number)
+def backfill_weeks(week_range):
+    first, _, last = week_range.partition(":")
+    first_year, first_week = [int(i) for i in first.split("-")]
+    last_year, last_week = [int(i) for i in (last or first).split("-")]
+    current = dt.fromisocalendar(first_year, first_week, 1)
+    last_date = dt.fromisocalendar(last_year, last_week, 1)
+    if last_date < current:
+        raise ValueError("{} is before {}".format(last, first))
+    weeks = []
+    while current <= last_date:
+        year, week = current.isocalendar()[:2]
+        weeks.append(week_dates(year, week))
+        current += timedelta(weeks = 1)
+    return weeks
+
+# get the total/available memory items of all servers with a single item.get call
+# returns {"host": {"tot_mem_id": {"itemid": id, "value_type": type}, "avail_mem_id": {...}}}
+def get_zabbix_items(client, servers, stats):
+    zabbix_dict = {}
+    for srv in servers:
+        zabbix_dict[srv] = {}
+    item_names = {key: item for item, key in memory_items.items()}
+    params = {"output": ["itemid", "hostid", "key_", "value_type"], "selectHosts": ["host"],
+        "filter": {"host": list(zabbix_dict), "key_": list(memory_items.values())}}
+    for result in client.call("item.get", params, stats.counter("zabbix_items")):
+        srv = result["hosts"][0]["host"]
+        if srv in zabbix_dict:
+            zabbix_dict[srv][item_names[result["key_"]]] = {"itemid": result["itemid"], "value_type": int(result["value_type"])}
+    return zabbix_dict
+
+# raw history aggregation without NumPy: samples are folded in a quantile sketch per item as
+# they are decoded, nothing keeps the whole week
+class SketchHistory:
+    def __init__(self, items):
+        self.sketches = {itemid: LogHistogram() for itemid in items}
+
+    def add_cached(self, itemid, values):
+        for value in values:
+            self.sketches[itemid].add(value)
+
+    # fold one history.get result in, returns {"itemid": (clocks, values)} of the day if to_cache
+    def add_day(self, itemids, result, to_cache):
+        day = {}
+        if to_cache:
+            for itemid in itemids:
+                day[itemid] = (array("q"), array("d"))
+        for sample in result:
+            value = float(sample["value"])
+            self.sketches[sample["itemid"]].add(value)
+            if to_cache:
+                clocks, values = day[sample["itemid"]]
+                clocks.append(int(sample["clock"]))
+                values.append(value)
+        return day
+
+    def stats(self):
+        return {itemid: sketch.stats() for itemid, sketch in self.sketches.items()}
+
+# raw history aggregation with NumPy: every history.get result (or cached day) becomes a chunk of
+# (item index, value) arrays, converted from the JSON strings in C, and stats() computes the stats
+# of all items at once over the concatenated samples (the week of all items is kept in memory,
+# 12 bytes per sample)
+class ArrayHistory:
+    def __init__(self, items):
+        self.itemids = sorted(items, key = int)
+        self.sorted_ids = numpy.array(self.itemids, dtype = numpy.int64)
+        self.index = {itemid: i for i, itemid in enumerate(self.itemids)}
+        self.index_chunks = []
+        self.value_chunks = []
+
+    def add_cached(self, itemid, values):
+        self.index_chunks.append(numpy.full(len(values), self.index[itemid], dtype = numpy.int32))
+        self.value_chunks.append(numpy.frombuffer(values, dtype = numpy.float64))
+
+    def add_day(self, itemids, result, to_cache):
+        index = numpy.searchsorted(self.sorted_ids, numpy.array([sample["itemid"] for sample in result], dtype = numpy.int64))
+        values = numpy.array([sample["value"] for sample in result], dtype = numpy.float64)
+        self.index_chunks.append(index.astype(numpy.int32))
+        self.value_chunks.append(values)
+        day = {}
+        if to_cache:
+            clocks = numpy.array([sample["clock"] for sample in result], dtype = numpy.int64)
+            # group the day's samples per item (stable, so clocks stay in the order Zabbix sent them)
+            order = numpy.argsort(index, kind = "stable")
+            counts = numpy.bincount(index, minlength = len(self.itemids))
+            offsets = numpy.concatenate(([0], numpy.cumsum(counts)))
+            for itemid in itemids:
+                i = self.index[itemid]
+                rows = order[offsets[i]:offsets[i + 1]]
+                day[itemid] = (array("q", clocks[rows].tobytes()), array("d", values[rows].tobytes()))
+        return day
+
+    # sort the samples by (item, value): each item is then a segment of the array, its sum comes from
+    # reduceat, its min/max/percentiles are plain lookups at offsets inside the segment
+    def stats(self):
+        result = {}
+        for itemid in self.itemids:
+            result[itemid] = {stat: 0 for stat in ram_stats}
+        if not self.value_chunks:
+            return result
+        index = numpy.concatenate(self.index_chunks)
+        values = numpy.concatenate(self.value_chunks)
+        if len(values) == 0:
+            return result
+        order = numpy.lexsort((values, index))
+        index = index[order]
+        values = values[order]
+        counts = numpy.bincount(index, minlength = len(self.itemids))
+        present = numpy.nonzero(counts)[0]
+        counts = counts[present]
+        starts = numpy.concatenate(([0], numpy.cumsum(counts)[:-1]))
+        columns = {"avg": numpy.floor(numpy.add.reduceat(values, starts) / counts),
+            "min": values[starts], "max": values[starts + counts - 1]}
+        for stat, q in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99)):
+            columns[stat] = values[starts + ((counts - 1) * q).astype(numpy.int64)]
+        for row, i in enumerate(present):
+            result[self.itemids[i]] = {stat: int(columns[stat][row]) for stat in ram_stats}
+        return result
+
+# history.get parameters of the samples of some items (of one value type) for one day
+def history_params(value_type, itemids, day_start, end_unixtime):
+    # time_from/time_till are both inclusive
+    return {"output": ["itemid", "clock", "value"], "history": value_type, "itemids": itemids,
+        "time_from": day_start, "time_till": min(day_start + 60 * 60 * 24, end_unixtime) - 1}
+
+# get the history of many items with as few calls as possible: the window is split in days and
+# we send one history.get per value type (history table) and day, fetched in parallel
+# days already in the on-disk cache are read from it and only the missing ones are requested
+# items is {"itemid": value_type}, returns {"itemid": {stat: value}} with the stats of ram_stats
+def get_history(client, items, start_unixtime, end_unixtime, stats, cache = None):
+    day_len = 60 * 60 * 24
+    history = ArrayHistory(items) if numpy is not None else SketchHistory(items)
+    # a recorded run must be replayable without the cache (which evicts old days), so days served
+    # (even partly) from it are also archived as the history.get call of all their items
+    recording = isinstance(client, RecordingClient)
+    # {(value_type, day_start): [itemids]}, all items and the ones missing from the cache
+    groups = {}
+    missing = {}
+    # {(value_type, day_start): [history.get samples]} of the cached days, when recording
+    cached_samples = {}
+    for day_start in range(start_unixtime, end_unixtime, day_len):
+        for itemid, value_type in items.items():
+            groups.setdefault((value_type, day_start), []).append(itemid)
+            cached = cache.get(itemid, day_start) if cache is not None else None
+            if cached is None:
+                missing.setdefault((value_type, day_start), []).append(itemid)
+                continue
+            history.add_cached(itemid, cached[1])
+            if recording:
+                cached_samples.setdefault((value_type, day_start), []).extend({"itemid": itemid, "clock": str(clock),
+                    "value": str(value)} for clock, value in zip(*cached))
+    reqs = [history_params(value_type, itemids, day_start, end_unixtime) for (value_type, day_start), itemids in missing.items()]
+    now = time.time()
+    for params, result in zip(reqs, client.map("history.get", reqs, stats.counter("zabbix_history"))):
+        group = (params["history"], params["time_from"])
+        if group in cached_samples:
+            cached_samples[group].extend(result)
+        # only days that are over can be cached, the current one may still get samples
+        to_cache = cache is not None and params["time_till"] < now
+        for itemid, (clocks, values) in history.add_day(params["itemids"], result, to_cache).items():
+            cache.put(itemid, params["time_from"], clocks, values)
+    for (value_type, day_start), samples in cached_samples.items():
+        client.record("history.get", history_params(value_type, groups[(value_type, day_start)], day_start, end_unixtime), samples)
+    if cache is not None and reqs:
+        cache.evict()
+    return history.stats()
+
+# get the hourly trends of many items with one trends.get call (works for both float and
+# unsigned items, Zabbix picks the trends table from the item), returns {"itemid": [trends rows]}
+def get_trends(client, itemids, start_unixtime, end_unixtime, stats):
+    params = {"output": ["itemid", "clock", "num", "value_min", "value_avg", "value_max"], "itemids": itemids,
+        "time_from": start_unixtime, "time_till": end_unixtime - 1}
+    trends_dict = {}
+    for hour in client.call("trends.get", params, stats.counter("zabbix_history")):
+        trends_dict.setdefault(hour["itemid"], []).append(hour)
+    return trends_dict
+
+# get total and available RAM stats from Zabbix for every server in the report
+# hourly trends are used where available, raw history only for items without trends
+# returns {"host": {"tot_mem_avg": MB, "tot_mem_min": MB, ..., "avail_mem_p99": MB}}, one key per item and ram_stats
+def get_zabbix_ram(client, servers, start_unixtime, end_unixtime, use_trends = True, cache = None, stats = None):
+    stats = stats or RunStats()
+    # create dictionary to store different values from Zabbix (itemid, value_type)
+    with stats.phase("zabbix_items"):
+        zabbix_dict = get_zabbix_items(client, servers, stats)
+    # and one for the RAM averages we compute from the Zabbix history
+    ram_dict = {}
+
+    for srv in servers:
+        ram_dict[srv] = {}
+        # hosts/items unknown to Zabbix get 0 in the report instead of breaking the run
+        for item in memory_items:
+            if item not in zabbix_dict[srv]:
+                print("No {} item in Zabbix for {}".format(memory_items[item], srv))
+                for stat in ram_stats:
+                    ram_dict[srv][item.rstrip("id") + stat] = 0
+
+    items = {}
+    for srv in zabbix_dict.keys():
+        for item in zabbix_dict[srv].values():
+            items[item["itemid"]] = item["value_type"]
+    # weekly stats per itemid
+    item_stats = {}
+    with stats.phase("zabbix_history"):
+        if use_trends:
+            print("Getting trends for {} items...".format(len(items)))
+            for itemid, data in get_trends(client, list(items), start_unixtime, end_unixtime, stats).items():
+                item_stats[itemid] = get_trends_stats(data)
+        # items without trends (or all of them if trends are disabled) fall back to raw history
+        missing = {itemid: items[itemid] for itemid in items if itemid not in item_stats}
+        if missing:
+            print("Getting history for {} items...".format(len(missing)))
+            item_stats.update(get_history(client, missing, start_unixtime, end_unixtime, stats, cache))
+
+    # add Zabbix values for total and available memory to RAM dictionary
+    for srv in zabbix_dict.keys():
+        for item in zabbix_dict[srv].keys():
+            values = item_stats[zabbix_dict[srv][item]["itemid"]]
+            # define new dictionary keys named <item_name_stat> (for eg. tot_mem_avg)
+            for stat in ram_stats:
+                ram_dict[srv][item.rstrip("id") + stat] = bytes_to_mbytes(values[stat])
+    return ram_dict
 
 # open connection to DB
-try:
-    cnx = mysql.connector.connect(**config)
-    cursor = cnx.cursor()
-except mysql.connector.Error as err:
-    if err.errno == errorcode.ER_ACCESS_DENIED_ERROR:
-        print("Something is wrong with your user name or password")
-        sys.exit(2)
-    elif err.errno == errorcode.ER_BAD_DB_ERROR:
-        print("Database does not exist")
-        sys.exit(2)
-    else:
+def db_connect():
+    try:
+        if db_pool is not None:
+            # more weeks may write at once than the pool holds connections, wait for one to come back
+            while True:
+                try:
+                    return db_pool.get_connection()
+                except mysql.connector.errors.PoolError:
+                    time.sleep(0.1)
+        return mysql.connector.connect(**config)
+    except mysql.connector.Error as err:
+        if err.errno == errorcode.ER_ACCESS_DENIED_ERROR:
+            print("Something is wrong with your user name or password")
+            sys.exit(2)
+        elif err.errno == errorcode.ER_BAD_DB_ERROR:
+            print("Database does not exist")
+            sys.exit(2)
+        else:
+            print(err)
+            sys.exit(2)
+
+# the upserts are written "col = VALUES(col)", the only form MariaDB and MySQL before 8.0.19 know;
+# MySQL 8.0.20+ deprecates it with a warning (1287) that raise_on_warnings turns into an error, so on
+# MySQL 8.0.19+ they use a row alias instead ("INSERT ... AS new ON DUPLICATE KEY UPDATE col = new.col")
+def upsert_sql(cnx, query):
+    if "mariadb" in cnx.get_server_info().lower() or tuple(cnx.get_server_version()) < (8, 0, 19):
+        return query
+    query = query.replace(" ON DUPLICATE KEY UPDATE ", " AS new ON DUPLICATE KEY UPDATE ")
+    return re.sub(r"VALUES\((\w+)\)", r"new.\1", query)
+
+# create the DB connection pool shared by the platforms and weeks reported in the same run, size is
+# how many of them may write at once (mysql-connector can't pool more than CNX_POOL_MAXSIZE connections)
+def open_db_pool(size):
+    global db_pool
+    try:
+        db_pool = mysql.connector.pooling.MySQLConnectionPool(pool_name = "k8s_report",
+            pool_size = min(size, mysql.connector.pooling.CNX_POOL_MAXSIZE), **config)
+    except mysql.connector.Error as err:
         print(err)
         sys.exit(2)
 
-# iterate over dictionary
-for srv in sorted(report_dict):
-    # define insert query for each server
-    ins_query = "INSERT INTO k8s_report (\
-    report_week,\
-    platform,\
-    server_name,\
-    k8s_cpu_no,\
-    k8s_cpu_limits,\
-    k8s_cpu_limits_perc,\
-    k8s_cpu_requests,\
-    k8s_cpu_requests_perc,\
-    k8s_mem_capacity,\
-    k8s_mem_limits,\
-    k8s_mem_limits_perc,\
-    k8s_mem_requests,\
-    k8s_mem_requests_perc,\
-    total_ram,\
-    available_ram) VALUES (\
-    '{0}', '{1}', '{2}', '{3}', '{4}', '{5}', '{6}', '{7}', '{8}', '{9}', '{10}', '{11}', '{12}', '{13}',\
-    '{14}')".format(report_number, platform, normalize_name(srv),\
-    report_dict[srv]['CPUs number'], report_dict[srv]['CPU limits'],\
-    report_dict[srv]['CPU limits percent'], report_dict[srv]['CPU requests'],\
-    report_dict[srv]['CPU requests percent'], report_dict[srv]['Memory capacity'],\
-    report_dict[srv]['Memory limits'], report_dict[srv]['Memory limits percent'],\
-    report_dict[srv]['Memory requests'], report_dict[srv]['Memory requests percent'],\
-    report_dict[srv]['tot_mem_avg'], report_dict[srv]['avail_mem_avg'])
+# build the k8s_report rows (in report_columns order) for all servers we have K8S data for
+def report_rows(platform, report_number, report_dict, ram_dict):
+    rows = []
+    for srv in sorted(report_dict):
+        node = report_dict[srv]
+        # skip servers for which kubectl returned no usable data
+        if node is None:
+            print("No K8S data for {}, skipping DB insert".format(srv))
+            continue
+        rows.append((report_number, platform, normalize_name(srv),
+            node.cpus_number, node.cpu_limits, node.cpu_limits_perc, node.cpu_requests, node.cpu_requests_perc,
+            node.memory_capacity, node.mem_limits, node.mem_limits_perc, node.mem_requests, node.mem_requests_perc,
+            ram_dict[srv]['tot_mem_avg'], ram_dict[srv]['avail_mem_avg'], ram_dict[srv]['avail_mem_min'],
+            ram_dict[srv]['avail_mem_p50'], ram_dict[srv]['avail_mem_p95'], ram_dict[srv]['avail_mem_p99']))
+    return rows
+
+# upsert all servers into the k8s_report table with one executemany in a single transaction
+def write_db(platform, report_number, report_dict, ram_dict):
+    cnx = db_connect()
+    cursor = cnx.cursor()
     try:
-        # insert into DB
-        cursor.execute(ins_query)
+        cursor.executemany(upsert_sql(cnx, upsert_query), report_rows(platform, report_number, report_dict, ram_dict))
         cnx.commit()
     except mysql.connector.Error as err:
+        cnx.rollback()
         print(err)
         print("DB insert failed.")
         sys.exit(2)
+    finally:
+        cursor.close()
+        cnx.close()
+
+# per namespace and per node pool (value of the pool_label node label) allocation totals, built from the
+# pods and labels we already got with the node allocations, returns {("namespace"|"pool", name): totals}
+# where totals follow rollup_columns from "nodes" on (CPU in millicores, memory in MB)
+def build_rollups(report_dict, details, pool_label):
+    rollups = {}
+    namespace_nodes = {}
+    for srv in sorted(details):
+        node = report_dict.get(srv)
+        detail = details[srv]
+        if node is None or detail is None:
+            continue
+        pool = rollups.setdefault(("pool", detail.labels.get(pool_label, "<none>")), [0] * 8)
+        pool[0] += 1
+        pool[1] += len(detail.pods)
+        pool[2] += conv_cpu_val(node.cpus_number)
+        pool[3] += node.cpu_requests
+        pool[4] += node.cpu_limits
+        pool[5] += node.memory_capacity
+        pool[6] += node.mem_requests
+        pool[7] += node.mem_limits
+        for pod in detail.pods:
+            namespace = rollups.setdefault(("namespace", pod.namespace), [0] * 8)
+            namespace_nodes.setdefault(pod.namespace, set()).add(srv)
+            namespace[1] += 1
+            namespace[3] += pod.cpu_requests
+            namespace[4] += pod.cpu_limits
+            namespace[6] += pod.mem_requests
+            namespace[7] += pod.mem_limits
+    for name, nodes in namespace_nodes.items():
+        rollups[("namespace", name)][0] = len(nodes)
+    return rollups
+
+# upsert the rollups of a week into the k8s_rollup table in a single transaction
+def write_rollups_db(platform, report_number, rollups):
+    rows = [(report_number, platform, kind, name) + tuple(totals) for (kind, name), totals in sorted(rollups.items())]
+    cnx = db_connect()
+    cursor = cnx.cursor()
+    try:
+        cursor.executemany(upsert_sql(cnx, rollup_upsert_query), rows)
+        cnx.commit()
+    except mysql.connector.Error as err:
+        cnx.rollback()
+        print(err)
+        print("DB insert of the rollups failed.")
+        sys.exit(2)
+    finally:
+        cursor.close()
+        cnx.close()
 
-cursor.close()
-cnx.close()
+# write the rollups in csv format to disk, next to the weekly report file
+def write_rollups_file(rollups_file, rollups):
+    try:
+        with open(rollups_file, "w") as report:
+            report.write("Type,Name,Nodes,Pods,CPU capacity(m),CPU requests(m),CPU limits(m),Memory capacity(MB),"
+                "Memory requests(MB),Memory limits(MB)\n")
+            for (kind, name), totals in sorted(rollups.items()):
+                report.write("{},{},{}\n".format(kind, name, ",".join(str(total) for total in totals)))
+    except IOError:
+        print("Can't open file for writting")
+        sys.exit(2)
 
-###FOURTH STEP - FILE REPORT###
-# append week number to end of report filename
-report_file = "{}_{}".format(report_file, report_number)
+# write the report week to the columnar store: one column per NodeRecord field and per RAM stat
+# (tot_mem_avg, ..., avail_mem_p99), servers without K8S data are skipped like in the DB
+def write_snapshot(store, platform, report_number, report_dict, ram_dict):
+    servers = [srv for srv in sorted(report_dict) if report_dict[srv] is not None]
+    columns = {}
+    for name, typecode in snapshot_columns.items():
+        if typecode == "d":
+            # the CPU capacity is a K8S quantity (cores, eg. "4" or "1500m"), the percents plain numbers
+            columns[name] = (typecode, [float(parse_quantity(getattr(report_dict[srv], name))) for srv in servers])
+        else:
+            columns[name] = (typecode, [getattr(report_dict[srv], name) for srv in servers])
+    for item in memory_items:
+        for stat in ram_stats:
+            name = item.rstrip("id") + stat
+            columns[name] = ("q", [ram_dict[srv][name] for srv in servers])
+    try:
+        store.write(platform, report_number, [normalize_name(srv) for srv in servers], columns)
+    except OSError as e:
+        print("Can't write snapshot {} {}: {}".format(platform, report_number, e))
+        sys.exit(2)
 
-print("Creating report file {}...".format(report_file))
+# header of the weekly report file, one name per column
+report_file_header = ["Server", "K8S CPUs number", "K8S CPU limits", "K8S CPU limits percent", "K8S CPU requests",
+    "K8S CPU requests percent", "K8S Memory capacity(MB)", "K8S Memory limits(MB)", "K8S Memory limits percent",
+    "K8S Memory requests(MB)", "K8S Memory requests percent", "Server total RAM average(MB)", "Server available RAM average(MB)",
+    "Server available RAM min(MB)", "Server available RAM p50(MB)", "Server available RAM p95(MB)", "Server available RAM p99(MB)"]
 
 # write report file in csv format to disk
-try:
-    with open(report_file, "a") as report:
-    # write header line first
-        report.write("Server,K8S CPUs number,K8S CPU limits,K8S CPU limits percent,K8S CPU requests,\
-        K8S CPU requests percent,K8S Memory capacity(MB),K8S Memory limits(MB),K8S Memory limits percent,K8S Memory requests(MB),\
-        K8S Memory requests percent,Server total RAM average(MB), Server available RAM average(MB)\n")
-        # iterate over dictionary and append the values to the file
-        for srv in sorted(report_dict):
-            # enclose in a try/except statement as I found ocasionally some server returns no data
+def write_report_file(report_file, report_dict, ram_dict):
+    try:
+        # the week's file is rewritten (reruns and backfills replace it), through a temporary file
+        # so readers never see it half written
+        with open(report_file + ".tmp", "w") as report:
+            # write header line first
+            report.write(",".join(report_file_header) + "\n")
+            # iterate over dictionary and append the values to the file
+            for srv in sorted(report_dict):
+                node = report_dict[srv]
+                # enclose in a try/except statement as I found ocasionally some server returns no data
+                try:
+                    report.write("{0},{1},{2},{3},{4},{5},{6},{7},{8},{9},{10},{11},{12},{13},{14},{15},{16}\n".format(normalize_name(srv), node.cpus_number, \
+                    node.cpu_limits, node.cpu_limits_perc, node.cpu_requests, \
+                    node.cpu_requests_perc, node.memory_capacity, node.mem_limits, \
+                    node.mem_limits_perc, node.mem_requests, \
+                    node.mem_requests_perc, ram_dict[srv]['tot_mem_avg'], ram_dict[srv]['avail_mem_avg'], \
+                    ram_dict[srv]['avail_mem_min'], ram_dict[srv]['avail_mem_p50'], ram_dict[srv]['avail_mem_p95'], \
+                    ram_dict[srv]['avail_mem_p99']))
+                # in case no data returned, write 0 in report for this server
+                except (AttributeError, KeyError):
+                    report.write("{},0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0\n".format(srv))
+        os.replace(report_file + ".tmp", report_file)
+    except IOError:
+        print("Can't open file for writting")
+        sys.exit(2)
+
+# position of the CPU capacity in a NodeRecord
+cpus_index = NodeRecord._fields.index("cpus_number")
+
+# streaming aggregates of one node's NodeRecord metrics: sample count, sum (for the average),
+# max and last value of each metric, all kept in fixed size lists
+class NodeAggregate:
+    __slots__ = ("samples", "sums", "maxs", "last")
+
+    def __init__(self):
+        self.samples = 0
+        self.sums = [0.0] * len(NodeRecord._fields)
+        self.maxs = [0.0] * len(NodeRecord._fields)
+        self.last = [0.0] * len(NodeRecord._fields)
+
+    # fold one NodeRecord into the aggregates (CPU capacity is a K8S quantity, in cores)
+    def add(self, record):
+        for i, value in enumerate(record):
+            value = float(parse_quantity(value)) if i == cpus_index else float(value)
+            self.sums[i] += value
+            self.maxs[i] = value if self.samples == 0 else max(self.maxs[i], value)
+            self.last[i] = value
+        self.samples += 1
+
+    # weekly NodeRecord built from the aggregates: capacity is the last value seen,
+    # requests and limits are the averages of the week
+    def record(self):
+        values = {}
+        for i, metric in enumerate(NodeRecord._fields):
+            value = self.last[i] if metric in ("cpus_number", "memory_capacity") else self.sums[i] / self.samples
+            values[metric] = int(round(value))
+        for metric in ("cpu_requests_perc", "cpu_limits_perc", "mem_requests_perc", "mem_limits_perc"):
+            values[metric] = str(values[metric])
+        # whole cores print like kubectl does ("4"), milli-CPU capacities keep their fraction ("1.5")
+        cpus = self.last[cpus_index]
+        values["cpus_number"] = str(int(cpus)) if cpus == int(cpus) else str(cpus)
+        return NodeRecord(**values)
+
+# load the aggregates already stored for a week (so a restarted daemon carries on where it left)
+# returns {"host": NodeAggregate}
+def load_aggregates(platform, report_number):
+    aggregates = {}
+    cnx = db_connect()
+    cursor = cnx.cursor()
+    cursor.execute(aggregate_select_query, (report_number, platform))
+    for srv, metric, samples, avg_value, max_value, last_value in cursor:
+        if metric not in NodeRecord._fields:
+            continue
+        node = aggregates.setdefault(srv, NodeAggregate())
+        i = NodeRecord._fields.index(metric)
+        node.samples = samples
+        node.sums[i] = avg_value * samples
+        node.maxs[i] = max_value
+        node.last[i] = last_value
+    cursor.close()
+    cnx.close()
+    return aggregates
+
+# upsert the aggregates of a week into the k8s_alloc_aggregate table in a single transaction
+def flush_aggregates(platform, report_number, aggregates):
+    rows = []
+    for srv in sorted(aggregates):
+        node = aggregates[srv]
+        for i, metric in enumerate(NodeRecord._fields):
+            rows.append((report_number, platform, srv, metric, node.samples,
+                node.sums[i] / node.samples, node.maxs[i], node.last[i]))
+    cnx = db_connect()
+    cursor = cnx.cursor()
+    try:
+        cursor.executemany(upsert_sql(cnx, aggregate_upsert_query), rows)
+        cnx.commit()
+    except mysql.connector.Error as err:
+        cnx.rollback()
+        print(err)
+        print("DB flush of the aggregates failed.")
+    finally:
+        cursor.close()
+        cnx.close()
+
+# weekly report records built from the stored daemon aggregates, returns {"host": NodeRecord}
+def aggregate_records(platform, report_number):
+    aggregates = load_aggregates(platform, report_number)
+    if not aggregates:
+        print("No aggregates stored for {} week {}, is the daemon running?".format(platform, report_number))
+        sys.exit(2)
+    return {srv: aggregates[srv].record() for srv in aggregates}
+
+# daemon mode: sample the node allocations every args.interval seconds and keep per node streaming
+# aggregates for the current ISO week, flushed to the DB every args.flush_interval seconds
+def run_daemon(platform, args):
+    # stop cleanly (flushing what we have) when the service manager stops us
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    year, week = dt.now().isocalendar()[:2]
+    report_number = "{}-{}".format(year, week)
+    aggregates = load_aggregates(platform, report_number)
+    last_flush = time.time()
+    print("Sampling {} every {}s, flushing every {}s...".format(platform, args.interval, args.flush_interval))
+    try:
+        while True:
+            started = time.time()
+            # a new week starts: flush what we have for the old one and start from scratch
+            year, week = dt.now().isocalendar()[:2]
+            if "{}-{}".format(year, week) != report_number:
+                flush_aggregates(platform, report_number, aggregates)
+                report_number = "{}-{}".format(year, week)
+                aggregates = {}
+                last_flush = time.time()
             try:
-                report.write("{0},{1},{2},{3},{4},{5},{6},{7},{8},{9},{10},{11},{12}\n".format(normalize_name(srv), report_dict[srv]['CPUs number'], \
-                report_dict[srv]['CPU limits'], report_dict[srv]['CPU limits percent'], report_dict[srv]['CPU requests'], \
-                report_dict[srv]['CPU requests percent'], report_dict[srv]['Memory capacity'], report_dict[srv]['Memory limits'], \
-                report_dict[srv]['Memory limits percent'], report_dict[srv]['Memory requests'], \
-                report_dict[srv]['Memory requests percent'], report_dict[srv]['tot_mem_avg'], report_dict[srv]['avail_mem_avg']))
-            # in case no data returned, write 0 in report for this server
-            except TypeError:
-                report.write("{},0,0,0,0,0,0,0,0,0,0,0,0\n".format(srv))
-except IOError:
-    print("Can't open file for writting")
-    sys.exit(2)
-
-print("Done!")
+                report_dict, details, failed = collect_k8s(platform, args)
+            except (pxssh.ExceptionPxssh, pexpect.EOF, ValueError) as e:
+                # a missed sample is not a reason to stop, try again next time
+                print("Sampling failed: {}".format(e))
+            else:
+                for srv, record in report_dict.items():
+                    if record is not None:
+                        aggregates.setdefault(srv, NodeAggregate()).add(record)
+                if failed:
+                    print("No data from {} node(s) (timed out or failed): {}".format(len(failed), ", ".join(failed)))
+            if time.time() - last_flush >= args.flush_interval:
+                flush_aggregates(platform, report_number, aggregates)
+                last_flush = time.time()
+            time.sleep(max(0, args.interval - (time.time() - started)))
+    finally:
+        if aggregates:
+            flush_aggregates(platform, report_number, aggregates)
+
+# add/override platforms from an INI config file, one section per platform, returns the platforms of the file:
+# [sca-prd]
+# k8s_hostname = <IP>
+# report_file = /home/claudtom/scripts/k8s_weekly_report_sca_prd
+def load_platforms(config_file):
+    parser = configparser.ConfigParser()
+    if not parser.read(config_file):
+        print("Cannot read config file {}".format(config_file))
+        sys.exit(1)
+    for section in parser.sections():
+        platforms[section] = {"k8s_hostname": parser.get(section, "k8s_hostname"),
+            "report_file": parser.get(section, "report_file")}
+    return parser.sections()
+
+# everything the sinks publish for a platform and week: {"host": NodeRecord}, {"host": {RAM stats}}
+# and the rollups (None when we have no pod data)
+WeekData = namedtuple("WeekData", ["platform", "report_number", "report_dict", "ram_dict", "rollups"])
+
+# publish sinks: each one writes a report week somewhere, they run concurrently (see report_week)
+# and stop the platform the usual way (print and exit) when they fail
+def db_sink(week, args, stats):
+    print("{} {}: adding data to DB...".format(week.platform, week.report_number))
+    with stats.phase("db_write"):
+        write_db(week.platform, week.report_number, week.report_dict, week.ram_dict)
+        if week.rollups is not None:
+            write_rollups_db(week.platform, week.report_number, week.rollups)
+    stats.add("db_write", calls = 1 if week.rollups is None else 2)
+
+def file_sink(week, args, stats):
+    # append week number to end of report filename
+    report_file = "{}_{}".format(platforms[week.platform]["report_file"], week.report_number)
+    print("{} {}: creating report file {}...".format(week.platform, week.report_number, report_file))
+    with stats.phase("file_write"):
+        write_report_file(report_file, week.report_dict, week.ram_dict)
+    stats.add("file_write", calls = 1, nbytes = os.path.getsize(report_file))
+    if week.rollups is not None:
+        rollups_file = "{}_rollup_{}".format(platforms[week.platform]["report_file"], week.report_number)
+        print("{} {}: writing {} rollups to {}...".format(week.platform, week.report_number, len(week.rollups), rollups_file))
+        with stats.phase("file_write"):
+            write_rollups_file(rollups_file, week.rollups)
+        stats.add("file_write", calls = 1, nbytes = os.path.getsize(rollups_file))
+
+def snapshot_sink(week, args, stats):
+    print("{} {}: adding data to snapshot store {}...".format(week.platform, week.report_number, args.snapshot_dir))
+    with stats.phase("snapshot_write"):
+        write_snapshot(SnapshotStore(args.snapshot_dir), week.platform, week.report_number, week.report_dict, week.ram_dict)
+    stats.add("snapshot_write", calls = 1)
+
+# replace the platform's section of the Confluence page, the table rows are the report rows
+# from server_name to available_ram
+def confluence_sink(week, args, stats):
+    print("{} {}: publishing to Confluence...".format(week.platform, week.report_number))
+    rows = [row[2:15] for row in report_rows(week.platform, week.report_number, week.report_dict, week.ram_dict)]
+    with stats.phase("confluence"):
+        confluence_upload.publish_platform(week.platform, rows)
+    stats.add("confluence", calls = 2)
+
+# Zabbix and publish (DB, files, snapshot, Confluence) steps of one report week, on top of the K8S data of the platform
+# details ({"host": NodeDetail}) feed the namespace/node pool rollups, None when we have no pod data
+# recorder holds the archived kubectl outputs of the collection (None when we don't archive)
+# returns True if the week was reported
+def report_week(platform, args, client, report_dict, details, recorder, dates, stats):
+    start_unixtime, end_unixtime, report_number = dates
+    archive = RawArchive(args.archive_dir)
+    if args.from_aggregates:
+        # allocations come from the aggregates the sampling daemon stored during the week
+        report_dict = aggregate_records(platform, report_number)
+        details = None
+    elif args.reprocess:
+        # K8S data and Zabbix responses both come from what that week's run archived
+        manifest = archive.manifest(platform, report_number)
+        if manifest is None:
+            print("{} {}: week not in the archive {}".format(platform, report_number, args.archive_dir))
+            return False
+        try:
+            report_dict, details, failed = archived_k8s(KubectlRecorder(archive, manifest["kubectl"]), manifest["mode"], stats)
+        except (OSError, ValueError) as e:
+            print("{} {}: cannot rebuild the K8S data from the archive.".format(platform, report_number))
+            print(e)
+            return False
+        if failed:
+            print("{} {}: no archived data for {} node(s): {}".format(platform, report_number, len(failed), ", ".join(failed)))
+        # the window of the archived run (a weekly run and --backfill don't compute the same one)
+        start_unixtime = manifest.get("start_unixtime", start_unixtime)
+        end_unixtime = manifest.get("end_unixtime", end_unixtime)
+        client = ReplayClient(archive, manifest["zabbix"], ZabbixError)
+    elif recorder is not None:
+        client = RecordingClient(client, archive)
+
+    ###SECOND STEP - ZABBIX DATA###
+    print("{} {}: connect to Zabbix API to get metrics...".format(platform, report_number))
+    try:
+        # raw history days are cached on disk so reruns and backfills only fetch the days they miss,
+        # a reprocessed week only uses what was archived
+        cache = None if args.no_cache or args.reprocess else HistoryCache()
+        ram_dict = get_zabbix_ram(client, report_dict.keys(), start_unixtime, end_unixtime, not args.no_trends, cache, stats)
+    except (requests.RequestException, ZabbixError, OSError) as e:
+        print("{} {}: Zabbix API call failed.".format(platform, report_number))
+        print(e)
+        return False
+
+    ###THIRD STEP - PUBLISH###
+    # namespace and node pool rollups, from the pod tables and labels collected with the allocations
+    rollups = build_rollups(report_dict, details, args.pool_label) if details is not None else None
+    # every sink gets the same in-memory week and they all run at once
+    week = WeekData(platform, report_number, report_dict, ram_dict, rollups)
+    sinks = [db_sink, file_sink]
+    if not args.no_snapshot:
+        sinks.append(snapshot_sink)
+    if args.confluence:
+        sinks.append(confluence_sink)
+    with ThreadPoolExecutor(max_workers = len(sinks)) as executor:
+        list(executor.map(lambda sink: sink(week, args, stats), sinks))
+
+    # archive the week last, only reported weeks can be reprocessed
+    if recorder is not None and not args.reprocess and not args.from_aggregates:
+        try:
+            manifest = build_manifest("json" if args.json else "describe", recorder, client, start_unixtime, end_unixtime)
+            # a rerun keeps the Zabbix calls the week's earlier runs archived (the new ones win)
+            previous = archive.manifest(platform, report_number)
+            if previous is not None:
+                manifest["zabbix"] = dict(previous["zabbix"], **manifest["zabbix"])
+            archive.save_manifest(platform, report_number, manifest)
+        except (OSError, ValueError) as e:
+            print("{} {}: can't archive the raw data: {}".format(platform, report_number, e))
+    return True
+
+# full report of one platform for one or more weeks: the K8S allocations are collected once
+# and the weeks (more than one when backfilling) get their Zabbix/DB/file steps in parallel
+# the Zabbix client and the DB pool are shared by all platforms of the run
+# returns True if all weeks of the platform were reported
+def run_platform(platform, args, client, weeks, stats):
+    # the steps below report errors the way the single platform script always did (print and exit),
+    # here we just stop this platform and let the others finish
+    try:
+        ###FIRST STEP - K8S DATA###
+        report_dict = details = recorder = None
+        if not args.no_archive and not args.reprocess and not args.from_aggregates:
+            try:
+                os.makedirs(args.archive_dir, exist_ok = True)
+                recorder = KubectlRecorder(RawArchive(args.archive_dir))
+            except OSError as e:
+                print("{}: can't use the raw archive, not archiving: {}".format(platform, e))
+        if not args.from_aggregates and not args.reprocess:
+            print("Running kubectl commands on {} cluster to get nodes/stats...".format(platform))
+            try:
+                report_dict, details, failed = collect_k8s(platform, args, stats, recorder)
+            except (pxssh.ExceptionPxssh, pexpect.EOF) as e:
+                print("{}: pxssh failed on login.".format(platform))
+                print(e)
+                return False
+            except ValueError as e:
+                print("{}: cannot parse kubectl output.".format(platform))
+                print(e)
+                return False
+
+            # partial failure: report the nodes we got no data for but carry on with the others
+            if failed:
+                print("{}: no data from {} node(s) (timed out or failed): {}".format(platform, len(failed), ", ".join(failed)))
+            print("{}: K8S data collected".format(platform))
+
+        with ThreadPoolExecutor(max_workers = min(len(weeks), backfill_workers)) as executor:
+            results = list(executor.map(lambda dates: report_week(platform, args, client, report_dict, details, recorder, dates, stats),
+                weeks))
+    except SystemExit:
+        return False
+    if not all(results):
+        return False
+    print("{}: done!".format(platform))
+    return True
+
+def main():
+    parser = argparse.ArgumentParser(description = "K8S cluster resources allocation and usage weekly report")
+    parser.add_argument("platform", nargs = "*", help = "K8S platform(s) to report on, collected concurrently")
+    parser.add_argument("--all", action = "store_true",
+        help = "report on all known platforms (all the platforms of the config file with --config)")
+    parser.add_argument("-c", "--config", help = "INI file with the platforms (k8s_hostname and report_file per section)")
+    parser.add_argument("-j", "--json", action = "store_true",
+        help = "get all nodes and pods with 2 'kubectl get -o json' calls instead of one 'kubectl describe' per node")
+    parser.add_argument("--no-trends", action = "store_true",
+        help = "compute RAM values from raw Zabbix history instead of hourly trends")
+    parser.add_argument("--no-cache", action = "store_true",
+        help = "don't use the on-disk cache of Zabbix history days")
+    parser.add_argument("-s", "--sessions", type = int, default = ssh_sessions,
+        help = "number of parallel SSH sessions for kubectl describe (default: {})".format(ssh_sessions))
+    parser.add_argument("-t", "--node-timeout", type = int, default = node_timeout,
+        help = "seconds to wait for kubectl describe of a single node (default: {})".format(node_timeout))
+    parser.add_argument("-d", "--daemon", action = "store_true",
+        help = "keep running, sample node allocations every --interval seconds and store weekly aggregates in the DB")
+    parser.add_argument("-i", "--interval", type = int, default = sample_interval,
+        help = "seconds between two samples in daemon mode (default: {})".format(sample_interval))
+    parser.add_argument("-f", "--flush-interval", type = int, default = flush_interval,
+        help = "seconds between two DB flushes of the aggregates in daemon mode (default: {})".format(flush_interval))
+    parser.add_argument("-a", "--from-aggregates", action = "store_true",
+        help = "build the report from the aggregates stored by the daemon instead of collecting from the cluster")
+    parser.add_argument("-b", "--backfill", metavar = "YEAR-WEEK[:YEAR-WEEK]",
+        help = "(re)generate the reports of an ISO week or range of weeks, eg. 2026-27:2026-39, using the current node allocations")
+    parser.add_argument("-r", "--reprocess", action = "store_true",
+        help = "rebuild the report week(s) from the raw archive, without connecting to the cluster or Zabbix")
+    parser.add_argument("--archive-dir", default = archive_dir,
+        help = "archive of the raw kubectl outputs and Zabbix responses (default: {})".format(archive_dir))
+    parser.add_argument("--no-archive", action = "store_true", help = "don't archive the raw data of this run")
+    parser.add_argument("--confluence", action = "store_true",
+        help = "also publish the platform's section of the Confluence report page (latest week only)")
+    parser.add_argument("--pool-label", default = pool_label,
+        help = "node label whose values are the node pools of the rollups (default: {})".format(pool_label))
+    parser.add_argument("--snapshot-dir", default = snapshot_dir,
+        help = "columnar snapshot store the report weeks are also written to (default: {})".format(snapshot_dir))
+    parser.add_argument("--no-snapshot", action = "store_true", help = "don't write the report weeks to the snapshot store")
+    parser.add_argument("--stats-file",
+        help = "where to write the JSON timing summary of the run (default: {})".format(stats_file.format("<date>")))
+    args = parser.parse_args()
+    started = time.time()
+    # with a config file, --all means the platforms of that file (the built-in ones can still be named)
+    config_platforms = load_platforms(args.config) if args.config else sorted(platforms)
+    selected = sorted(config_platforms) if args.all else args.platform
+    if not selected:
+        parser.error("no platform given, use --all or one or more of: {}".format(", ".join(sorted(platforms))))
+    for platform in selected:
+        if platform not in platforms:
+            parser.error("unknown platform {}, choose from: {}".format(platform, ", ".join(sorted(platforms))))
+
+    if args.reprocess and (args.daemon or args.from_aggregates):
+        parser.error("--reprocess rebuilds weeks from the raw archive, it can't be combined with --daemon or --from-aggregates")
+    if args.confluence and args.backfill:
+        parser.error("--confluence publishes the latest week, it can't be combined with --backfill")
+    if args.daemon:
+        if len(selected) != 1:
+            parser.error("daemon mode samples a single platform")
+        run_daemon(selected[0], args)
+        return
+
+    # date math, Zabbix login and DB connections are done once for all platforms
+    if args.backfill:
+        try:
+            weeks = backfill_weeks(args.backfill)
+        except ValueError as e:
+            parser.error("invalid --backfill range: {}".format(e))
+        print("Backfilling weeks {}".format(", ".join(dates[2] for dates in weeks)))
+    else:
+        weeks = [report_dates()]
+    # each week being reported holds at most one DB connection at a time, a single week doesn't need a pool
+    concurrent_weeks = len(selected) * min(len(weeks), backfill_workers)
+    if concurrent_weeks > 1:
+        open_db_pool(concurrent_weeks)
+    # the client reuses the token cached by the previous run and keeps its connections open
+    client = ZabbixClient(zabbix_url, zabbix_username, zabbix_password, workers = zabbix_workers)
+    # per phase timings, remote calls and bytes of every platform
+    run_stats = {platform: RunStats() for platform in selected}
+    try:
+        with ThreadPoolExecutor(max_workers = len(selected)) as executor:
+            results = dict(zip(selected, executor.map(
+                lambda platform: run_platform(platform, args, client, weeks, run_stats[platform]), selected)))
+    finally:
+        client.close()
+        summary_file = args.stats_file or stats_file.format(time.strftime("%Y%m%dT%H%M%S", time.localtime(started)))
+        try:
+            write_summary(summary_file, started, run_stats)
+            print("Run statistics written to {}".format(summary_file))
+        except IOError as e:
+            print("Can't write run statistics: {}".format(e))
+
+    failed = [platform for platform in selected if not results[platform]]
+    if failed:
+        print("Report failed for: {}".format(", ".join(failed)))
+        sys.exit(2)
+    print("Done!")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+# Benchmark of the K8S resources collector (k8s-resource-usage-cron.py) without production access
+# - synthetic clusters: realistic "kubectl describe node" (and -o json) outputs served by fake SSH sessions
+# - a local stand-in Zabbix JSON-RPC server (separate process) replaying recorded or generated history
+# - an SQLite stand-in for the MySQL DB step
+# reports end to end and per phase time for every cluster size
+# Date: October 2026
+
+import argparse, importlib.util, json, multiprocessing, os, random, re, sqlite3, sys, tempfile, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+collector_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "k8s-resource-usage-cron.py")
+namespaces = ["kube-system", "monitoring", "logging", "ingress", "payments", "accounts", "search", "batch"]
+phases = ["ssh", "parse", "zabbix_items", "zabbix_history", "db_write", "file_write", "snapshot_write"]
+
+parser = argparse.ArgumentParser(description = "Benchmark the K8S collector against synthetic clusters, a fake Zabbix and SQLite")
+parser.add_argument("--sizes", default = "10,100,1000,5000", help = "comma separated cluster sizes (default: 10,100,1000,5000)")
+parser.add_argument("--mode", choices = ["describe", "json"], default = "describe",
+    help = "collector K8S mode: one describe per node or the 2 call JSON snapshot (default: describe)")
+parser.add_argument("--sessions", type = int, default = 8, help = "parallel SSH sessions in describe mode (default: 8)")
+parser.add_argument("--ssh-latency", type = float, default = 0.05, help = "seconds every fake kubectl command takes (default: 0.05)")
+parser.add_argument("--no-trends", action = "store_true", help = "make the collector use raw history instead of trends")
+parser.add_argument("--history-interval", type = int, default = 300,
+    help = "seconds between two generated history samples (default: 300)")
+parser.add_argument("--recording", help = "JSON file with recorded Zabbix payloads to replay: {\"history\": [values], \"trends\": [rows]}")
+parser.add_argument("--seed", type = int, default = 42, help = "random seed of the synthetic clusters")
+parser.add_argument("--output", help = "also write the results as JSON to this file")
+
+### Synthetic cluster ###
+# build a cluster model: nodes with capacity, labels and the requests/limits of their pods
+def generate_cluster(size, rng):
+    nodes = []
+    for i in range(size):
+        cpus = rng.choice([4, 8, 16, 32])
+        mem_ki = cpus * 4 * 1024 * 1024 - rng.randint(100000, 400000)
+        pods = []
+        for j in range(rng.randint(5, 30)):
+            cpu_req = rng.choice([0, 50, 100, 250, 500, 1000])
+            mem_req = rng.choice([0, 64, 128, 256, 512, 1024])
+            pods.append({"namespace": rng.choice(namespaces), "name": "pod-{:05d}-{:02d}-{:05x}".format(i, j, rng.getrandbits(20)),
+                "cpu_req": cpu_req, "cpu_lim": cpu_req * rng.choice([0, 1, 2]),
+                "mem_req": mem_req, "mem_lim": mem_req * rng.choice([0, 1, 2])})
+        nodes.append({"name": "bench-node-{:05d}".format(i), "cpus": cpus, "mem_ki": mem_ki,
+            "labels": {"kubernetes.io/hostname": "bench-node-{:05d}".format(i), "nodepool": rng.choice(["general", "highmem", "batch"])},
+            "pods": pods})
+    return nodes
+
+def cpu_str(milli):
+    return "{}m".format(milli) if milli else "0"
+
+def mem_str(mega):
+    return "{}Mi".format(mega) if mega else "0"
+
+def perc_str(val, total):
+    return "({}%)".format(val * 100 // total)
+
+# "kubectl describe node" output of a node, in the format the collector parses
+def describe_output(node):
+    cpu_total = node["cpus"] * 1000
+    mem_total = node["mem_ki"] // 1024
+    lines = ["Name:\t\t\t{}".format(node["name"]), "Role:\t\t\t"]
+    labels = ["{}={}".format(key, value) for key, value in sorted(node["labels"].items())]
+    lines.append("Labels:\t\t\t{}".format(labels[0]))
+    lines.extend("\t\t\t{}".format(label) for label in labels[1:])
+    lines.extend(["Taints:\t\t\t<none>", "CreationTimestamp:\tMon, 03 Apr 2017 10:12:44 +0000", "Phase:\t\t\t",
+        "Conditions:", "  Type\t\t\tStatus\tLastHeartbeatTime\t\t\tReason\t\t\t\tMessage",
+        "  ----\t\t\t------\t-----------------\t\t\t------\t\t\t\t-------",
+        "  Ready \t\tTrue \tMon, 10 Apr 2017 08:00:00 +0000\tKubeletReady \t\t\tkubelet is posting ready status",
+        "Addresses:\t\t10.0.0.1,10.0.0.1,{}".format(node["name"]),
+        "Capacity:",
+        " alpha.kubernetes.io/nvidia-gpu:\t0",
+        " cpu:\t\t\t\t\t{}".format(node["cpus"]),
+        " memory:\t\t\t\t{}Ki".format(node["mem_ki"]),
+        " pods:\t\t\t\t\t110",
+        "Allocatable:",
+        " alpha.kubernetes.io/nvidia-gpu:\t0",
+        " cpu:\t\t\t\t\t{}".format(node["cpus"]),
+        " memory:\t\t\t\t{}Ki".format(node["mem_ki"]),
+        " pods:\t\t\t\t\t110",
+        "System Info:",
+        " Machine ID:\t\t\t0123456789abcdef",
+        " Kernel Version:\t\t3.10.0-514.el7.x86_64",
+        " OS Image:\t\t\tCentOS Linux 7 (Core)",
+        " Container Runtime Version:\tdocker://1.12.6",
+        " Kubelet Version:\t\tv1.6.1",
+        "ExternalID:\t\t\t{}".format(node["name"]),
+        "Non-terminated Pods:\t\t({} in total)".format(len(node["pods"])),
+        "  Namespace\t\t\tName\t\t\t\tCPU Requests\tCPU Limits\tMemory Requests\tMemory Limits",
+        "  ---------\t\t\t----\t\t\t\t------------\t----------\t---------------\t-------------"])
+    totals = [0, 0, 0, 0]
+    for pod in node["pods"]:
+        lines.append("  {}\t\t\t{}\t\t{} {}\t{} {}\t{} {}\t{} {}".format(pod["namespace"], pod["name"],
+            cpu_str(pod["cpu_req"]), perc_str(pod["cpu_req"], cpu_total), cpu_str(pod["cpu_lim"]), perc_str(pod["cpu_lim"], cpu_total),
+            mem_str(pod["mem_req"]), perc_str(pod["mem_req"], mem_total), mem_str(pod["mem_lim"]), perc_str(pod["mem_lim"], mem_total)))
+        totals = [totals[0] + pod["cpu_req"], totals[1] + pod["cpu_lim"], totals[2] + pod["mem_req"], totals[3] + pod["mem_lim"]]
+    lines.extend(["Allocated resources:",
+        "  (Total limits may be over 100 percent, i.e., overcommitted.)",
+        "  CPU Requests\tCPU Limits\tMemory Requests\tMemory Limits",
+        "  ------------\t----------\t---------------\t-------------",
+        "  {} {}\t{} {}\t{} {}\t{} {}".format(cpu_str(totals[0]), perc_str(totals[0], cpu_total),
+            cpu_str(totals[1]), perc_str(totals[1], cpu_total), mem_str(totals[2]), perc_str(totals[2], mem_total),
+            mem_str(totals[3]), perc_str(totals[3], mem_total)),
+        "Events:\t\t<none>"])
+    return "\n".join(lines) + "\n"
+
+# "kubectl get nodes -o json" and "kubectl get pods --all-namespaces -o json" outputs of the cluster
+def json_outputs(cluster):
+    nodes = {"kind": "List", "items": []}
+    pods = {"kind": "List", "items": []}
+    for node in cluster:
+        resources = {"cpu": str(node["cpus"]), "memory": "{}Ki".format(node["mem_ki"]), "pods": "110"}
+        nodes["items"].append({"metadata": {"name": node["name"], "labels": node["labels"]},
+            "status": {"capacity": resources, "allocatable": dict(resources)}})
+        for pod in node["pods"]:
+            requests, limits = {}, {}
+            if pod["cpu_req"]:
+                requests["cpu"] = cpu_str(pod["cpu_req"])
+            if pod["mem_req"]:
+                requests["memory"] = mem_str(pod["mem_req"])
+            if pod["cpu_lim"]:
+                limits["cpu"] = cpu_str(pod["cpu_lim"])
+            if pod["mem_lim"]:
+                limits["memory"] = mem_str(pod["mem_lim"])
+            pods["items"].append({"metadata": {"name": pod["name"], "namespace": pod["namespace"]},
+                "spec": {"nodeName": node["name"], "containers": [{"name": "app", "resources": {"requests": requests, "limits": limits}}]},
+                "status": {"phase": "Running"}})
+    return json.dumps(nodes, indent = 4), json.dumps(pods, indent = 4)
+
+# answers the kubectl commands the collector sends, like a pxssh session would
+# (before holds the echoed command and the output with \r\n line ends, as bytes)
+class FakeSession:
+    def __init__(self, outputs, latency):
+        self.outputs = outputs
+        self.latency = latency
+        self.before = b""
+        self.comm = ""
+
+    def sendline(self, comm):
+        self.comm = comm
+
+    def prompt(self, timeout = -1):
+        time.sleep(self.latency)
+        output = self.outputs(self.comm)
+        self.before = (self.comm + "\n" + output).replace("\n", "\r\n").encode()
+        return True
+
+    def logout(self):
+        pass
+
+    def close(self):
+        pass
+
+# command -> output function for a cluster
+def cluster_outputs(cluster):
+    by_name = {node["name"]: node for node in cluster}
+    cache = {}
+    def outputs(comm):
+        if comm.startswith("kubectl get no |"):
+            return "".join(node["name"] + "\n" for node in cluster)
+        if comm.startswith("kubectl describe no "):
+            return describe_output(by_name[comm.split()[-1]])
+        if "-o json" in comm:
+            if "json" not in cache:
+                cache["json"] = json_outputs(cluster)
+            return cache["json"][1 if "pods" in comm else 0]
+        return ""
+    return outputs
+
+### Fake Zabbix ###
+# JSON-RPC handler replaying the recorded (or generated) payload for every item it is asked about
+class ZabbixHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    recording = None
+    history_interval = 300
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        params = request.get("params") or {}
+        method = request["method"]
+        if method == "user.login":
+            result = "bench-token"
+        elif method == "item.get":
+            result = []
+            hosts = params.get("filter", {}).get("host", [])
+            keys = params.get("filter", {}).get("key_", [])
+            for i, host in enumerate(hosts):
+                for k, key in enumerate(keys):
+                    result.append({"itemid": str(i * len(keys) + k + 1), "hostid": str(i + 1), "key_": key,
+                        "value_type": "3", "hosts": [{"host": host}]})
+        elif method == "trends.get":
+            result = []
+            rows = self.recording["trends"]
+            for itemid in params["itemids"]:
+                for n, clock in enumerate(range(int(params["time_from"]) // 3600 * 3600, int(params["time_till"]) + 1, 3600)):
+                    row = rows[n % len(rows)]
+                    result.append({"itemid": itemid, "clock": str(clock), "num": str(row["num"]),
+                        "value_min": str(row["value_min"]), "value_avg": str(row["value_avg"]), "value_max": str(row["value_max"])})
+        elif method == "history.get":
+            result = []
+            values = self.recording["history"]
+            itemids = params["itemids"] if isinstance(params["itemids"], list) else [params["itemids"]]
+            for itemid in itemids:
+                for n, clock in enumerate(range(int(params["time_from"]), int(params["time_till"]) + 1, self.history_interval)):
+                    result.append({"itemid": itemid, "clock": str(clock), "value": str(values[n % len(values)])})
+        else:
+            result = []
+        body = json.dumps({"jsonrpc": "2.0", "result": result, "id": request.get("id")}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+# payload replayed when no recording is given: a day of total (16G) and available memory samples
+def default_recording():
+    rng = random.Random(0)
+    history = [rng.randint(2, 12) * 1024 ** 3 for i in range(288)]
+    trends = [{"num": 12, "value_min": min(history[h * 12:h * 12 + 12]), "value_max": max(history[h * 12:h * 12 + 12]),
+        "value_avg": sum(history[h * 12:h * 12 + 12]) // 12} for h in range(24)]
+    return {"history": history, "trends": trends}
+
+# run the fake Zabbix in its own process so its JSON encoding doesn't compete with the collector for the GIL
+def serve_zabbix(recording, history_interval, port_queue):
+    ZabbixHandler.recording = recording
+    ZabbixHandler.history_interval = history_interval
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ZabbixHandler)
+    port_queue.put(server.server_port)
+    server.serve_forever()
+
+### SQLite stand-in for MySQL ###
+# unique keys the collector's upserts rely on
+unique_keys = {"k8s_report": "report_week, platform, server_name", "k8s_rollup": "report_week, platform, kind, name"}
+
+# turn the collector's MySQL queries into SQLite ones (placeholders and upsert syntax)
+def to_sqlite(query):
+    query = query.replace("%s", "?")
+    table = re.search(r"INSERT INTO (\w+)", query)
+    if table and "ON DUPLICATE KEY UPDATE" in query:
+        query = re.sub(r"VALUES\((\w+)\)", r"excluded.\1", query)
+        query = query.replace("ON DUPLICATE KEY UPDATE", "ON CONFLICT({}) DO UPDATE SET".format(unique_keys[table.group(1)]))
+    return query
+
+class SQLiteCursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, query, params = ()):
+        self.cursor.execute(to_sqlite(query), params)
+
+    def executemany(self, query, rows):
+        self.cursor.executemany(to_sqlite(query), rows)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def close(self):
+        self.cursor.close()
+
+# behaves like a mysql.connector connection for what the collector uses; close() keeps the DB open
+class SQLiteConnection:
+    def __init__(self, report_columns, rollup_columns):
+        self.db = sqlite3.connect(":memory:", check_same_thread = False)
+        self.db.execute("CREATE TABLE k8s_report ({}, UNIQUE ({}))".format(", ".join(report_columns), unique_keys["k8s_report"]))
+        self.db.execute("CREATE TABLE k8s_rollup ({}, UNIQUE ({}))".format(", ".join(rollup_columns), unique_keys["k8s_rollup"]))
+
+    def cursor(self):
+        return SQLiteCursor(self.db.cursor())
+
+    # the collector picks its upsert syntax from the server version, SQLite gets the VALUES() form to_sqlite() knows
+    def get_server_info(self):
+        return "SQLite " + sqlite3.sqlite_version
+
+    def get_server_version(self):
+        return sqlite3.sqlite_version_info
+
+    def commit(self):
+        self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
+
+    def close(self):
+        pass
+
+    def count(self, table = "k8s_report"):
+        return self.db.execute("SELECT COUNT(*) FROM {}".format(table)).fetchone()[0]
+
+### Benchmark ###
+# load the collector script as a module (its name has dashes so it can't be imported normally)
+def load_collector():
+    sys.path.insert(0, os.path.dirname(collector_file))
+    spec = importlib.util.spec_from_file_location("k8s_collector", collector_file)
+    collector = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(collector)
+    return collector
+
+# run the collector end to end against a synthetic cluster, returns the result line of this size
+def run_size(collector, size, args, zabbix_url, work_dir):
+    rng = random.Random(args.seed + size)
+    cluster = generate_cluster(size, rng)
+    outputs = cluster_outputs(cluster)
+    db = SQLiteConnection(collector.report_columns, collector.rollup_columns)
+    zabbix_client = collector.ZabbixClient
+
+    collector.platforms = {"bench": {"k8s_hostname": "bench", "report_file": os.path.join(work_dir, "report_{}".format(size))}}
+    collector.zabbix_url = zabbix_url
+    collector.ssh_connect = lambda k8s_hostname: FakeSession(outputs, args.ssh_latency)
+    collector.db_connect = lambda: db
+    collector.open_db_pool = lambda pool_size: None
+    collector.ZabbixClient = lambda *client_args, **kwargs: zabbix_client(*client_args, token_file = None, **kwargs)
+
+    stats_file = os.path.join(work_dir, "stats_{}.json".format(size))
+    argv = ["k8s-resource-usage-cron.py", "bench", "--no-cache", "--stats-file", stats_file, "--sessions", str(args.sessions),
+        "--snapshot-dir", os.path.join(work_dir, "snapshots"), "--archive-dir", os.path.join(work_dir, "archive")]
+    if args.mode == "json":
+        argv.append("--json")
+    if args.no_trends:
+        argv.append("--no-trends")
+    saved_argv, saved_stdout = sys.argv, sys.stdout
+    sys.argv = argv
+    started = time.perf_counter()
+    try:
+        # the collector is chatty, keep its output out of the results
+        with open(os.devnull, "w") as devnull:
+            sys.stdout = devnull
+            collector.main()
+    finally:
+        elapsed = time.perf_counter() - started
+        sys.argv, sys.stdout = saved_argv, saved_stdout
+        collector.ZabbixClient = zabbix_client
+    with open(stats_file) as summary:
+        stats = json.load(summary)["platforms"]["bench"]["phases"]
+    return {"size": size, "total": round(elapsed, 3), "rows": db.count(),
+        "phases": {phase: stats.get(phase, {}).get("wall_time", 0.0) for phase in phases},
+        "ssh_calls": stats.get("ssh", {}).get("calls", 0),
+        "zabbix_calls": stats.get("zabbix_items", {}).get("calls", 0) + stats.get("zabbix_history", {}).get("calls", 0),
+        "zabbix_bytes": stats.get("zabbix_items", {}).get("bytes", 0) + stats.get("zabbix_history", {}).get("bytes", 0)}
+
+def main():
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",")]
+    if args.recording:
+        with open(args.recording) as recording_file:
+            recording = json.load(recording_file)
+    else:
+        recording = default_recording()
+
+    port_queue = multiprocessing.Queue()
+    zabbix = multiprocessing.Process(target = serve_zabbix, args = (recording, args.history_interval, port_queue), daemon = True)
+    zabbix.start()
+    zabbix_url = "http://127.0.0.1:{}/api_jsonrpc.php".format(port_queue.get(timeout = 30))
+
+    collector = load_collector()
+    results = []
+    print("{:>6} {:>9} {}  {:>6} {:>7} {:>12}".format("nodes", "total(s)", " ".join("{:>14}".format(phase) for phase in phases),
+        "ssh#", "zabbix#", "zabbix bytes"))
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            for size in sizes:
+                result = run_size(collector, size, args, zabbix_url, work_dir)
+                results.append(result)
+                print("{:>6} {:>9.3f} {}  {:>6} {:>7} {:>12}".format(size, result["total"],
+                    " ".join("{:>14.3f}".format(result["phases"][phase]) for phase in phases),
+                    result["ssh_calls"], result["zabbix_calls"], result["zabbix_bytes"]))
+                if result["rows"] != size:
+                    print("WARNING: {} rows in the DB for {} nodes".format(result["rows"], size))
+    finally:
+        zabbix.terminate()
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump({"mode": args.mode, "sessions": args.sessions, "ssh_latency": args.ssh_latency,
+                "trends": not args.no_trends, "results": results}, output, indent = 2)
+
+if __name__ == '__main__':
+    main()
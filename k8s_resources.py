@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# Kubernetes resources parsing shared by the capacity scripts (k8s-resource-usage-cron.py and
+# capacity_report_gsma_hsa.py): the full quantity grammar (n/u/m, k/M/G/T/P/E, Ki..Ei, exponents,
+# decimals), the kubectl describe node parser and the allocation math on JSON nodes/pods
+# run on its own it checks the quantity grammar against a table of examples
+# Date: October 2026
+
+import math, re, sys
+from collections import namedtuple
+from decimal import Decimal, InvalidOperation
+from functools import lru_cache
+
+# multipliers for the suffixes allowed in a K8S resource quantity (eg. 500m, 2Gi, 1.5G)
+quantity_suffixes = {
+    "": 1, "n": Decimal("1e-9"), "u": Decimal("1e-6"), "m": Decimal("1e-3"),
+    "k": 10**3, "M": 10**6, "G": 10**9, "T": 10**12, "P": 10**15, "E": 10**18,
+    "Ki": 2**10, "Mi": 2**20, "Gi": 2**30, "Ti": 2**40, "Pi": 2**50, "Ei": 2**60,
+}
+# a bare "E" is the exa suffix, it is only an exponent when digits follow it
+quantity_re = re.compile(r"^(?P<number>[+-]?(?:[0-9]+(?:\.[0-9]*)?|\.[0-9]+))"
+    r"(?:(?P<exponent>[eE][+-]?[0-9]+)|(?P<suffix>[KMGTPE]i|[numkMGTPE]))?$")
+
+# convert a K8S resource quantity string into a Decimal in base units (cores or bytes)
+# the same few quantities (100m, 128Mi, ...) come back thousands of times per cluster, so results are memoized
+# raises ValueError for anything that is not a quantity
+@lru_cache(maxsize = 4096)
+def parse_quantity(val):
+    match = quantity_re.match(str(val).strip())
+    if not match:
+        raise ValueError("invalid quantity: {}".format(val))
+    try:
+        if match.group("exponent"):
+            return Decimal(match.group("number") + match.group("exponent"))
+        return Decimal(match.group("number")) * quantity_suffixes[match.group("suffix") or ""]
+    except InvalidOperation:
+        raise ValueError("invalid quantity: {}".format(val))
+
+# describe output blocks we look for
+capacity_re = re.compile(r"^ *Capacity:")
+requests_re = re.compile(r"^ *CPU Requests")
+
+# convert a CPU quantity from k8s into milicpu format (eg. from 1 to 1000, 1.5 to 1500, 250m to 250)
+def conv_cpu_val(val):
+    return milli_cpu(parse_quantity(val))
+
+# convert a memory quantity from k8s into MB (eg. from 4046588Ki to 3951, 2Gi to 2048 or 1G to 953)
+def conv_mem_val(val):
+    return int(parse_quantity(val)) // 1024 // 1024
+
+# compact per-node record holding all k8s capacity/allocation metrics we report on
+# (a namedtuple is slotted, so 600+ of them cost next to nothing)
+NodeRecord = namedtuple("NodeRecord", ["cpus_number", "memory_capacity", "cpu_requests", "cpu_requests_perc",
+    "cpu_limits", "cpu_limits_perc", "mem_requests", "mem_requests_perc", "mem_limits", "mem_limits_perc"])
+# per pod allocations (millicores and MB) and node labels, for the namespace and node pool rollups
+PodRecord = namedtuple("PodRecord", ["namespace", "name", "cpu_requests", "cpu_limits", "mem_requests", "mem_limits"])
+NodeDetail = namedtuple("NodeDetail", ["labels", "pods"])
+
+# scan the kubectl describe output of a node (list of lines) in a single pass: capacity and allocated
+# resources always, labels and the "Non-terminated Pods" table too when with_detail
+# returns (NodeRecord, NodeDetail or None), (None, None) if the output misses the capacity or allocated resources
+def scan_node(data, with_detail):
+    cpus_number = memory_capacity = None
+    allocated = None
+    labels = {}
+    pods = []
+    block = None
+    i = 0
+    while i < len(data):
+        line = data[i]
+        # blocks end at the first line that is not indented
+        if block is not None and not line[:1].isspace():
+            block = None
+        if block == "capacity":
+            key, _, value = line.strip().partition(":")
+            if key == "cpu":
+                cpus_number = value.strip()
+            elif key == "memory":
+                memory_capacity = conv_mem_val(value.strip())
+        elif block == "labels":
+            key, sep, value = line.strip().partition("=")
+            if sep:
+                labels[key] = value
+        elif block == "pods":
+            # namespace, name and 4 "value (percent)" pairs, newer kubectl adds an Age column
+            fields = line.split()
+            if len(fields) >= 10 and fields[0] not in ("Namespace", "---------"):
+                pods.append(PodRecord(namespace = fields[0], name = fields[1],
+                    cpu_requests = conv_cpu_val(fields[2]), cpu_limits = conv_cpu_val(fields[4]),
+                    mem_requests = conv_mem_val(fields[6]), mem_limits = conv_mem_val(fields[8])))
+        # search for the line that contains "Capacity:" to get CPU and memory allocated
+        if capacity_re.match(line):
+            block = "capacity"
+        # search for the line that starts with "CPU Requests", values are 2 lines below it
+        elif requests_re.match(line) and i+2 < len(data):
+            allocated = data[i+2].split()
+            i += 2
+        elif with_detail and line.startswith("Labels:"):
+            # the first label is on the "Labels:" line itself
+            block = "labels"
+            key, sep, value = line[len("Labels:"):].strip().partition("=")
+            if sep:
+                labels[key] = value
+        elif with_detail and line.startswith("Non-terminated Pods:"):
+            block = "pods"
+        i += 1
+    if cpus_number is None or memory_capacity is None or allocated is None or len(allocated) < 8:
+        return None, None
+    record = NodeRecord(
+        cpus_number = cpus_number,
+        memory_capacity = memory_capacity,
+        cpu_requests = conv_cpu_val(allocated[0]),
+        cpu_requests_perc = allocated[1].strip("()").strip("%"),
+        cpu_limits = conv_cpu_val(allocated[2]),
+        cpu_limits_perc = allocated[3].strip("()").strip("%"),
+        mem_requests = conv_mem_val(allocated[4]),
+        mem_requests_perc = allocated[5].strip("()").strip("%"),
+        mem_limits = conv_mem_val(allocated[6]),
+        mem_limits_perc = allocated[7].strip("()").strip("%"))
+    return record, NodeDetail(labels = labels, pods = pods) if with_detail else None
+
+# NodeRecord of the kubectl describe output of a node, None if it misses the capacity or allocated resources
+def parse_node(data):
+    return scan_node(data, False)[0]
+
+# NodeRecord and NodeDetail (labels and pods) of the kubectl describe output of a node, from the same
+# single pass, (None, None) if it misses the capacity or allocated resources
+def parse_node_describe(data):
+    return scan_node(data, True)
+
+# empty CPU/memory requests and limits counters
+def empty_totals():
+    return {"requests": {"cpu": Decimal(0), "memory": Decimal(0)}, "limits": {"cpu": Decimal(0), "memory": Decimal(0)}}
+
+# sum the requests/limits of a pod the same way kubectl describe does:
+# sum of all app containers, init containers count only if they ask for more, plus pod overhead
+def pod_requests_limits(pod):
+    totals = empty_totals()
+    spec = pod.get("spec", {})
+    for container in spec.get("containers", []):
+        resources = container.get("resources", {})
+        for kind in totals:
+            for res in ("cpu", "memory"):
+                if res in resources.get(kind, {}):
+                    totals[kind][res] += parse_quantity(resources[kind][res])
+    for container in spec.get("initContainers", []):
+        resources = container.get("resources", {})
+        for kind in totals:
+            for res in ("cpu", "memory"):
+                if res in resources.get(kind, {}):
+                    totals[kind][res] = max(totals[kind][res], parse_quantity(resources[kind][res]))
+    for res, val in spec.get("overhead", {}).items():
+        if res in ("cpu", "memory"):
+            for kind in totals:
+                totals[kind][res] += parse_quantity(val)
+    return totals
+
+# convert cores into millicores, rounding up like K8S does
+def milli_cpu(val):
+    return int(math.ceil(val * 1000))
+
+# percentage string (truncated, like kubectl describe prints it) of val from total
+def percent(val, total):
+    return str(int(val / total * 100)) if total else "0"
+
+# describe only counts the pods scheduled on a node that are not terminated
+def pod_counted(pod):
+    return bool(pod.get("spec", {}).get("nodeName")) and pod.get("status", {}).get("phase") not in ("Succeeded", "Failed")
+
+# add (sign 1) or remove (sign -1) the requests/limits of a pod to the totals of its node
+def add_totals(node_sums, totals, sign = 1):
+    for kind in totals:
+        for res in totals[kind]:
+            node_sums[kind][res] += sign * totals[kind][res]
+
+# NodeRecord of a node (JSON object) from the requests/limits totals of its pods
+def node_record(node, node_sums):
+    capacity = node.get("status", {}).get("capacity", {})
+    allocatable = node.get("status", {}).get("allocatable") or capacity
+    alloc_cpu = parse_quantity(allocatable.get("cpu", 0)) * 1000
+    alloc_mem = parse_quantity(allocatable.get("memory", 0))
+    return NodeRecord(
+        cpus_number = str(capacity.get("cpu", "0")),
+        memory_capacity = int(parse_quantity(capacity.get("memory", 0))) // 1024 // 1024,
+        cpu_requests = milli_cpu(node_sums["requests"]["cpu"]),
+        cpu_requests_perc = percent(milli_cpu(node_sums["requests"]["cpu"]), alloc_cpu),
+        cpu_limits = milli_cpu(node_sums["limits"]["cpu"]),
+        cpu_limits_perc = percent(milli_cpu(node_sums["limits"]["cpu"]), alloc_cpu),
+        mem_requests = int(node_sums["requests"]["memory"]) // 1024 // 1024,
+        mem_requests_perc = percent(node_sums["requests"]["memory"], alloc_mem),
+        mem_limits = int(node_sums["limits"]["memory"]) // 1024 // 1024,
+        mem_limits_perc = percent(node_sums["limits"]["memory"], alloc_mem))
+
+# build a NodeRecord per node from "kubectl get nodes -o json" and "kubectl get pods -o json" output,
+# giving the same numbers kubectl describe shows (percentages are relative to allocatable)
+# returns ({"host": NodeRecord}, {"host": NodeDetail})
+def parse_nodes_json(nodes_json, pods_json):
+    sums = {}
+    node_pods = {}
+    for pod in pods_json.get("items", []):
+        if not pod_counted(pod):
+            continue
+        node_name = pod["spec"]["nodeName"]
+        totals = pod_requests_limits(pod)
+        add_totals(sums.setdefault(node_name, empty_totals()), totals)
+        metadata = pod.get("metadata", {})
+        node_pods.setdefault(node_name, []).append(PodRecord(namespace = metadata.get("namespace", "default"),
+            name = metadata.get("name", ""), cpu_requests = milli_cpu(totals["requests"]["cpu"]),
+            cpu_limits = milli_cpu(totals["limits"]["cpu"]), mem_requests = int(totals["requests"]["memory"]) // 1024 // 1024,
+            mem_limits = int(totals["limits"]["memory"]) // 1024 // 1024))
+    records = {}
+    details = {}
+    for node in nodes_json.get("items", []):
+        srv = node["metadata"]["name"]
+        details[srv] = NodeDetail(labels = node["metadata"].get("labels") or {}, pods = node_pods.get(srv, []))
+        records[srv] = node_record(node, sums.get(srv) or empty_totals())
+    return records, details
+
+# quantities of the K8S grammar and their value in base units, checked when this file is run
+quantity_examples = [
+    ("1", "1"), ("0", "0"), ("1.5", "1.5"), ("+2", "2"), (".5", "0.5"), ("2.", "2"),
+    ("250m", "0.25"), ("100u", "0.0001"), ("5n", "0.000000005"),
+    ("1k", "1000"), ("2M", "2000000"), ("1.5G", "1500000000"), ("1T", "1000000000000"), ("1P", "1000000000000000"),
+    ("2E", "2000000000000000000"),
+    ("1Ki", "1024"), ("128Mi", "134217728"), ("2Gi", "2147483648"), ("1Ti", "1099511627776"), ("0.5Ti", "549755813888"),
+    ("1Pi", "1125899906842624"), ("1Ei", "1152921504606846976"),
+    ("1e3", "1000"), ("1E3", "1000"), ("12e-3", "0.012"), ("1.5e+2", "150"),
+]
+# strings that are not quantities, parse_quantity must raise ValueError for them
+invalid_quantities = ["", ".", "1.2.3", "1..", "m", "1Ki2", "1e", "1E+", "1ki", "1Mb", "--1", "1 Gi"]
+
+def check_quantities():
+    errors = 0
+    for val, expected in quantity_examples:
+        if parse_quantity(val) != Decimal(expected):
+            print("{}: got {}, expected {}".format(val, parse_quantity(val), expected))
+            errors += 1
+    for val in invalid_quantities:
+        try:
+            print("{!r}: got {}, expected ValueError".format(val, parse_quantity(val)))
+            errors += 1
+        except ValueError:
+            pass
+    print("{} quantities checked, {} error(s)".format(len(quantity_examples) + len(invalid_quantities), errors))
+    return errors
+
+if __name__ == '__main__':
+    sys.exit(1 if check_quantities() else 0)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# Streaming quantile estimation for the Zabbix history of the K8S report
+# log bucketed histogram: every value falls in a bucket whose bounds grow by a fixed ratio, so
+# any quantile is known within a relative error and memory only depends on the range of the values
+# (about 1400 buckets at most for byte values up to 1 TB), never on the number of samples
+# Date: October 2026
+
+import math
+
+# default relative accuracy of the quantiles (1%)
+accuracy = 0.01
+
+class LogHistogram:
+    __slots__ = ("gamma", "log_gamma", "buckets", "zeros", "count", "total", "min", "max")
+
+    def __init__(self, alpha = accuracy):
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.log_gamma = math.log(self.gamma)
+        # {bucket index: count}, bucket i holds the values in (gamma^(i-1), gamma^i]
+        self.buckets = {}
+        # values <= 0 have no log, memory values never go below 0 so we just count them
+        self.zeros = 0
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    # fold a value in, count > 1 folds the same value several times (eg. a trends hour average
+    # weighted by the number of samples behind it)
+    def add(self, value, count = 1):
+        if count <= 0:
+            return
+        if value > 0:
+            index = math.ceil(math.log(value) / self.log_gamma)
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        else:
+            self.zeros += count
+        self.count += count
+        self.total += value * count
+        self.widen(value, value)
+
+    # extend the exact min/max without adding samples (trends carry the true hourly min/max)
+    def widen(self, min_val, max_val):
+        self.min = min_val if self.min is None else min(self.min, min_val)
+        self.max = max_val if self.max is None else max(self.max, max_val)
+
+    def average(self):
+        return self.total / self.count if self.count else 0.0
+
+    # value below which a q (0..1) fraction of the samples fall, within the relative accuracy
+    def quantile(self, q):
+        if self.count == 0:
+            return 0.0
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if rank < seen:
+                # middle of the bucket (in relative terms), clamped to the values we really saw
+                value = 2 * self.gamma ** index / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    # weekly stats of the report: avg, exact min/max and the p50/p95/p99 estimates
+    def stats(self):
+        if self.count == 0:
+            return {"avg": 0, "min": 0, "max": 0, "p50": 0, "p95": 0, "p99": 0}
+        return {"avg": int(self.total // self.count), "min": int(self.min), "max": int(self.max),
+            "p50": int(self.quantile(0.50)), "p95": int(self.quantile(0.95)), "p99": int(self.quantile(0.99))}
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# Archive of the raw inputs of the K8S collector (kubectl outputs and Zabbix responses)
+# outputs are stored once per content (zlib compressed blobs named by their sha256, most node
+# descriptions don't change from one week to the next), each platform and report week gets a
+# manifest listing which blobs it used, so a report can be re-derived offline
+# layout: <root>/blobs/<sha[:2]>/<sha>.z and <root>/manifests/<platform>/<report_week>.json
+# Date: October 2026
+
+import hashlib, json, os, threading, time, zlib
+
+# default archive location
+archive_dir = os.path.expanduser("~/k8s_raw_archive")
+
+class RawArchive:
+    def __init__(self, root = archive_dir):
+        self.root = root
+
+    def blob_name(self, sha):
+        return os.path.join(self.root, "blobs", sha[:2], sha + ".z")
+
+    # store a blob (bytes) unless we already have the same content, returns its sha256
+    def put(self, data):
+        sha = hashlib.sha256(data).hexdigest()
+        name = self.blob_name(sha)
+        if not os.path.exists(name):
+            os.makedirs(os.path.dirname(name), exist_ok = True)
+            # unique temporary name, several threads may store the same new blob at once
+            tmp_name = "{}.{}.{}.tmp".format(name, os.getpid(), threading.get_ident())
+            with open(tmp_name, "wb") as blob:
+                blob.write(zlib.compress(data))
+            os.replace(tmp_name, name)
+        return sha
+
+    def get(self, sha):
+        with open(self.blob_name(sha), "rb") as blob:
+            return zlib.decompress(blob.read())
+
+    def manifest_name(self, platform, report_week):
+        return os.path.join(self.root, "manifests", platform, report_week + ".json")
+
+    def save_manifest(self, platform, report_week, manifest):
+        name = self.manifest_name(platform, report_week)
+        os.makedirs(os.path.dirname(name), exist_ok = True)
+        with open(name + ".tmp", "w") as manifest_file:
+            json.dump(manifest, manifest_file, indent = 1)
+        os.replace(name + ".tmp", name)
+
+    # manifest of a platform and week, None if that week was never archived
+    def manifest(self, platform, report_week):
+        try:
+            with open(self.manifest_name(platform, report_week)) as manifest_file:
+                return json.load(manifest_file)
+        except FileNotFoundError:
+            return None
+
+# collects the kubectl outputs of one collection (command -> blob sha), shared by the sessions
+# (or gives them back, when built from the outputs of a manifest)
+class KubectlRecorder:
+    def __init__(self, archive, outputs = None):
+        self.archive = archive
+        self.lock = threading.Lock()
+        self.outputs = dict(outputs or {})
+
+    def record(self, comm, output):
+        sha = self.archive.put(output)
+        with self.lock:
+            self.outputs[comm] = sha
+
+    # raw output (bytes, as the SSH session returned it) of a command
+    def output(self, comm):
+        sha = self.outputs.get(comm)
+        return self.archive.get(sha) if sha is not None else None
+
+# SSH session wrapper recording the raw output (before) of every command that got its prompt back
+class RecordingSession:
+    def __init__(self, session, recorder):
+        self.session = session
+        self.recorder = recorder
+        self.comm = None
+
+    def sendline(self, comm):
+        self.comm = comm
+        return self.session.sendline(comm)
+
+    def prompt(self, *args, **kwargs):
+        matched = self.session.prompt(*args, **kwargs)
+        if matched:
+            self.recorder.record(self.comm, self.session.before)
+        return matched
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+# key of a Zabbix call in the manifest: method and params, params with sorted keys
+def call_key(method, params):
+    return json.dumps([method, params], sort_keys = True)
+
+# Zabbix client wrapper recording every call and its response (same call/map interface)
+class RecordingClient:
+    def __init__(self, client, archive):
+        self.client = client
+        self.archive = archive
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def record(self, method, params, result):
+        sha = self.archive.put(json.dumps(result).encode())
+        with self.lock:
+            self.calls[call_key(method, params)] = sha
+
+    def call(self, method, params, counter = None):
+        result = self.client.call(method, params, counter)
+        self.record(method, params, result)
+        return result
+
+    def map(self, method, params_list, counter = None):
+        results = self.client.map(method, params_list, counter)
+        for params, result in zip(params_list, results):
+            self.record(method, params, result)
+        return results
+
+# answers Zabbix calls from a manifest instead of the API, calls that were not archived (eg. history
+# days that came from the history cache) raise error
+class ReplayClient:
+    def __init__(self, archive, calls, error = LookupError):
+        self.archive = archive
+        self.calls = calls
+        self.error = error
+
+    def call(self, method, params, counter = None):
+        sha = self.calls.get(call_key(method, params))
+        if sha is None:
+            raise self.error("{} call not in the archive: {}".format(method, json.dumps(params)[:200]))
+        data = self.archive.get(sha)
+        if counter is not None:
+            counter(len(data))
+        return json.loads(data.decode())
+
+    def map(self, method, params_list, counter = None):
+        return [self.call(method, params, counter) for params in params_list]
+
+# manifest of a report week: the K8S collection mode, the time window the Zabbix data covers
+# (the calls are replayed by their exact time_from/time_till), the kubectl outputs and the Zabbix calls
+def build_manifest(mode, kubectl, zabbix, start_unixtime, end_unixtime):
+    return {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "mode": mode,
+        "start_unixtime": start_unixtime, "end_unixtime": end_unixtime,
+        "kubectl": dict(kubectl.outputs), "zabbix": dict(zabbix.calls)}
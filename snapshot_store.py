@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# Columnar store of the weekly K8S capacity data
+# every report week of a platform is a partition directory holding one typed array file per metric
+# (plus the server names), so a query over many weeks only reads (memory maps) the columns it needs
+# layout: <root>/<platform>/<report_week>/{meta.json, servers.json, <metric>.col}
+# Date: October 2026
+
+import argparse, json, mmap, os, shutil, sys
+from array import array
+
+# bumped when the partition layout changes
+store_version = 1
+
+# sort key of a report week ("2026-7" -> (2026, 7)), report weeks are not zero padded
+def week_key(report_week):
+    year, _, week = report_week.partition("-")
+    return int(year), int(week)
+
+# the columns of one partition, memory mapped: columns are memoryviews cast to their array type
+# (zero copy, valid until close())
+class Partition:
+    def __init__(self, path, names = None):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as meta_file:
+            self.meta = json.load(meta_file)
+        if self.meta["byteorder"] != sys.byteorder:
+            raise ValueError("{}: written on a {} endian machine".format(path, self.meta["byteorder"]))
+        self.maps = []
+        self.columns = {}
+        # don't leave the columns mapped so far behind when one can't be loaded
+        try:
+            for name in names if names is not None else self.meta["columns"]:
+                self.columns[name] = self.load(name)
+        except BaseException:
+            self.close()
+            raise
+
+    # map a column, ValueError if the partition doesn't have it
+    def load(self, name):
+        if name not in self.meta["columns"]:
+            raise ValueError("{}: no {} column (columns: {})".format(self.path, name, ", ".join(sorted(self.meta["columns"]))))
+        typecode = self.meta["columns"][name]
+        if self.meta["rows"] == 0:
+            return memoryview(array(typecode))
+        with open(os.path.join(self.path, name + ".col"), "rb") as column_file:
+            mapped = mmap.mmap(column_file.fileno(), 0, access = mmap.ACCESS_READ)
+        self.maps.append(mapped)
+        return memoryview(mapped).cast(typecode)
+
+    def servers(self):
+        with open(os.path.join(self.path, "servers.json")) as servers_file:
+            return json.load(servers_file)
+
+    def close(self):
+        for column in self.columns.values():
+            column.release()
+        for mapped in self.maps:
+            mapped.close()
+        self.columns = {}
+        self.maps = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class SnapshotStore:
+    def __init__(self, root):
+        self.root = root
+
+    def partition_path(self, platform, report_week):
+        return os.path.join(self.root, platform, report_week)
+
+    # write (or replace, on reruns) the partition of a platform and week
+    # columns is {"metric": (typecode, values)}, all with one value per server
+    def write(self, platform, report_week, servers, columns):
+        path = self.partition_path(platform, report_week)
+        tmp_path = path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors = True)
+        os.makedirs(tmp_path)
+        meta = {"version": store_version, "byteorder": sys.byteorder, "rows": len(servers), "columns": {}}
+        for name, (typecode, values) in columns.items():
+            data = array(typecode, values)
+            if len(data) != len(servers):
+                raise ValueError("column {} has {} values for {} servers".format(name, len(data), len(servers)))
+            with open(os.path.join(tmp_path, name + ".col"), "wb") as column_file:
+                data.tofile(column_file)
+            meta["columns"][name] = typecode
+        with open(os.path.join(tmp_path, "servers.json"), "w") as servers_file:
+            json.dump(list(servers), servers_file)
+        # meta.json goes last, a partition without it is incomplete
+        with open(os.path.join(tmp_path, "meta.json"), "w") as meta_file:
+            json.dump(meta, meta_file, indent = 2, sort_keys = True)
+        # swap the partition in, the old one (if any) is only removed once the new one is complete
+        if os.path.isdir(path):
+            old_path = path + ".old"
+            shutil.rmtree(old_path, ignore_errors = True)
+            os.rename(path, old_path)
+            os.rename(tmp_path, path)
+            shutil.rmtree(old_path, ignore_errors = True)
+        else:
+            os.rename(tmp_path, path)
+
+    def platforms(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name for name in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, name)))
+
+    # complete partitions of a platform, in week order, optionally limited to [first, last]
+    def weeks(self, platform, first = None, last = None):
+        path = os.path.join(self.root, platform)
+        if not os.path.isdir(path):
+            return []
+        weeks = []
+        for name in os.listdir(path):
+            if name.endswith((".tmp", ".old")) or not os.path.isfile(os.path.join(path, name, "meta.json")):
+                continue
+            if first is not None and week_key(name) < week_key(first):
+                continue
+            if last is not None and week_key(name) > week_key(last):
+                continue
+            weeks.append(name)
+        return sorted(weeks, key = week_key)
+
+    # open a partition, loading only the given columns (all if names is None)
+    def open(self, platform, report_week, names = None):
+        return Partition(self.partition_path(platform, report_week), names)
+
+# print per week count/avg/max of some metrics of a platform, eg. to compare with last year
+def main():
+    parser = argparse.ArgumentParser(description = "Query the K8S capacity snapshot store")
+    parser.add_argument("root", help = "snapshot store directory")
+    parser.add_argument("platform", help = "K8S platform")
+    parser.add_argument("metric", nargs = "+", help = "metric column(s) to summarize")
+    parser.add_argument("--from", dest = "first", metavar = "YEAR-WEEK", help = "first report week")
+    parser.add_argument("--to", dest = "last", metavar = "YEAR-WEEK", help = "last report week")
+    args = parser.parse_args()
+
+    store = SnapshotStore(args.root)
+    weeks = store.weeks(args.platform, args.first, args.last)
+    # check the metrics against the first week before printing anything
+    if weeks:
+        try:
+            store.open(args.platform, weeks[0], args.metric).close()
+        except ValueError as e:
+            parser.error(e)
+    print("week,servers," + ",".join("{0} avg,{0} max".format(metric) for metric in args.metric))
+    for report_week in weeks:
+        try:
+            partition = store.open(args.platform, report_week, args.metric)
+        except ValueError as e:
+            print(e, file = sys.stderr)
+            sys.exit(2)
+        with partition:
+            values = []
+            for metric in args.metric:
+                column = partition.columns[metric]
+                values.append("{:.1f}".format(sum(column) / len(column)) if len(column) else "0")
+                values.append(str(max(column, default = 0)))
+            print("{},{},{}".format(report_week, partition.meta["rows"], ",".join(values)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# Zabbix JSON-RPC API client shared by the reporting scripts
+# keeps a pool of keep-alive connections, runs batches of calls in parallel and caches
+# the auth token on disk so we don't log in again on every run
+# Date: October 2026
+
+import json, os, threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+# default location of the auth token cache
+token_file = os.path.expanduser("~/.zabbix_token")
+
+class ZabbixError(Exception):
+    pass
+
+class ZabbixClient:
+    def __init__(self, url, username, password, token_file = token_file, workers = 8, timeout = 120):
+        self.url = url
+        self.username = username
+        self.password = password
+        self.token_file = token_file
+        self.workers = workers
+        self.timeout = timeout
+        self.token = None
+        self.lock = threading.Lock()
+        # one keep-alive connection per worker thread
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections = 1, pool_maxsize = workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Content-Type": "application/json"})
+        self.executor = ThreadPoolExecutor(max_workers = workers)
+
+    # send one JSON-RPC request and return the decoded response
+    # counter (if given) is called with the size of every response, for call/bytes statistics
+    def post(self, method, params, auth, counter = None):
+        payload = {"jsonrpc": "2.0", "method": method, "params": params, "auth": auth, "id": 1}
+        response = self.session.post(self.url, data = json.dumps(payload), timeout = self.timeout)
+        response.raise_for_status()
+        if counter is not None:
+            counter(len(response.content))
+        return response.json()
+
+    # log in and save the new token to the cache file (readable only by us)
+    def login(self):
+        response = self.post("user.login", {"user": self.username, "password": self.password}, None)
+        if "error" in response:
+            raise ZabbixError("Zabbix login failed: {}".format(response["error"]))
+        self.token = response["result"]
+        if self.token_file:
+            try:
+                fd = os.open(self.token_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                os.fchmod(fd, 0o600)
+                with os.fdopen(fd, "w") as cache:
+                    json.dump({"url": self.url, "user": self.username, "token": self.token}, cache)
+            except OSError as e:
+                print("Cannot save Zabbix token to {}: {}".format(self.token_file, e))
+        return self.token
+
+    # return the current token: the one in memory, the cached one (not checked, we find out
+    # on the first call if it expired) or a brand new one
+    def get_token(self):
+        with self.lock:
+            if self.token is None and self.token_file:
+                try:
+                    with open(self.token_file) as cache:
+                        cached = json.load(cache)
+                    if cached.get("url") == self.url and cached.get("user") == self.username:
+                        self.token = cached.get("token")
+                except (OSError, ValueError):
+                    pass
+            if self.token is None:
+                self.login()
+            return self.token
+
+    # the token expired or was logged out: log in again, only once if several threads notice it
+    def renew_token(self, old_token):
+        with self.lock:
+            if self.token == old_token:
+                self.login()
+            return self.token
+
+    # call an API method and return its result, logging in again if the cached token is no longer valid
+    def call(self, method, params, counter = None):
+        token = self.get_token()
+        response = self.post(method, params, token, counter)
+        if "error" in response and is_auth_error(response["error"]):
+            response = self.post(method, params, self.renew_token(token), counter)
+        if "error" in response:
+            raise ZabbixError("Zabbix {} failed: {}".format(method, response["error"]))
+        return response["result"]
+
+    # call the same method with every set of params in parallel, results are returned in the same order
+    def map(self, method, params_list, counter = None):
+        return list(self.executor.map(lambda params: self.call(method, params, counter), params_list))
+
+    def close(self):
+        self.executor.shutdown()
+        self.session.close()
+
+# Zabbix answers an expired/invalid session with an "invalid params" error
+def is_auth_error(error):
+    data = "{} {}".format(error.get("message", ""), error.get("data", ""))
+    return "re-login" in data or "Not authorised" in data or "Not authorized" in data
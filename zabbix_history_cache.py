@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# On-disk cache of Zabbix history, one file per (itemid, day)
+# each file holds the clocks and values of one item for one day as packed arrays, zlib compressed,
+# so reruns and backfills only have to ask Zabbix for the days they don't have yet
+# Date: October 2026
+
+import os, struct, zlib
+from array import array
+
+# default cache location and size limit (least recently used days are evicted above it)
+cache_dir = os.path.expanduser("~/.cache/zabbix_history")
+cache_size = 512 * 1024 * 1024
+
+# file header: number of samples
+header = struct.Struct("<I")
+
+class HistoryCache:
+    def __init__(self, path = cache_dir, max_bytes = cache_size):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(self.path, exist_ok = True)
+
+    def file_name(self, itemid, day_start):
+        return os.path.join(self.path, str(itemid), "{}.bin".format(int(day_start)))
+
+    # return (clocks, values) arrays for an item and day, or None if the day is not cached
+    def get(self, itemid, day_start):
+        name = self.file_name(itemid, day_start)
+        try:
+            with open(name, "rb") as cache:
+                data = zlib.decompress(cache.read())
+        except (OSError, zlib.error):
+            return None
+        count = header.unpack_from(data)[0]
+        clocks = array("q")
+        values = array("d")
+        offset = header.size
+        clocks.frombytes(data[offset:offset + count * clocks.itemsize])
+        offset += count * clocks.itemsize
+        values.frombytes(data[offset:offset + count * values.itemsize])
+        # touch the file, eviction goes by last use
+        os.utime(name)
+        return clocks, values
+
+    # store the samples of an item for a full day (an empty day is stored too, so we don't ask again)
+    def put(self, itemid, day_start, clocks, values):
+        name = self.file_name(itemid, day_start)
+        os.makedirs(os.path.dirname(name), exist_ok = True)
+        data = header.pack(len(clocks)) + array("q", clocks).tobytes() + array("d", values).tobytes()
+        # write to a temporary file first so a crash never leaves a truncated day behind
+        with open(name + ".tmp", "wb") as cache:
+            cache.write(zlib.compress(data))
+        os.replace(name + ".tmp", name)
+
+    # remove the least recently used days until the cache fits in max_bytes
+    def evict(self):
+        files = []
+        total = 0
+        for root, dirs, names in os.walk(self.path):
+            for name in names:
+                full_name = os.path.join(root, name)
+                try:
+                    stat = os.stat(full_name)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, full_name))
+                total += stat.st_size
+        for mtime, size, full_name in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(full_name)
+                total -= size
+            except OSError:
+                pass